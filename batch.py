@@ -1,77 +1,178 @@
+import os
 import argparse
+import hashlib
 import shutil
 import subprocess
-import tempfile
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
 from pathlib import Path
 
+from cache import DiskCache
+from pipeline import ByteBudget
+from stats import Stats, no_stats
+from structs.game_list import game_list
 from xp3 import XP3
 
 
-def process_audio_files(folder: Path, speed: float):
-    """处理文件夹中的所有 .ogg 文件"""
-    for ogg_file in folder.rglob("*.ogg"):
-        output_file = ogg_file.parent / f"temp_{ogg_file.name}"
-
-        # 使用 ffmpeg 加速音频但不改变音高
-        cmd = [
-            "ffmpeg",
-            "-i",
-            str(ogg_file),
-            "-filter:a",
-            f"atempo={speed}",
-            "-vn",
-            str(output_file),
-            "-y",  # 覆盖已存在的文件
-        ]
-
+class AudioSpeedup:
+    """
+    通过管道用 ffmpeg 加速 ogg 音频但不改变音高，可以在多个线程中同时调用，按文件记录错误
+    给出 cache 时按 (原文件内容哈希, 倍率, ffmpeg 参数) 缓存结果，重复运行或不同游戏中相同的文件不再调用 ffmpeg
+    给出 stats 时 ffmpeg 的耗时记在 transcode 阶段
+    """
+
+    def __init__(self, speed: float, cache: DiskCache = None, stats: Stats = None):
+        self.speed = speed
+        self.cache = cache
+        self.stats = stats or no_stats
+        self.args = ["-filter:a", f"atempo={speed}", "-vn", "-f", "ogg"]
+        self.errors: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str, data: bytes) -> bytes:
+        """返回加速后的音频，出错时记录错误并返回原数据"""
+        key = None
+        if self.cache is not None:
+            key = DiskCache.key(hashlib.sha256(data).hexdigest(), self.speed, self.args)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        cmd = ["ffmpeg", "-i", "pipe:0", *self.args, "pipe:1"]
         try:
-            subprocess.run(cmd, check=True, capture_output=True)
-            # 替换原文件
-            output_file.replace(ogg_file)
-        except subprocess.CalledProcessError as e:
-            print(f"处理 {ogg_file} 时出错: {e}")
-            output_file.unlink(missing_ok=True)
-
-
-def process_xp3(xp3_path: Path, encryption: str, speed: float):
-    """处理单个 XP3 文件"""
+            with self.stats.measure("transcode", len(data)):
+                processed = subprocess.run(cmd, input=data, check=True, capture_output=True).stdout
+        except (subprocess.CalledProcessError, OSError) as e:
+            with self._lock:
+                self.errors[name] = str(e)
+            return data
+
+        # 出错的结果不缓存，下次运行会重试
+        if key is not None:
+            self.cache.put(key, processed)
+        return processed
+
+    def report(self):
+        """打印处理出错的文件"""
+        for name, error in self.errors.items():
+            print(f"处理 {name} 时出错: {error}")
+
+
+def process_xp3(
+    xp3_path: Path,
+    encryption: str,
+    speed: float,
+    executor: Executor,
+    depth: int = 16,
+    budget: ByteBudget = None,
+    cache: DiskCache = None,
+    stats: Stats = None,
+):
+    """
+    处理单个 XP3 文件，只解码并重新压缩 .ogg 文件，其余文件原样复制
+    executor、budget、cache 和 stats 可以在同时处理的多个 XP3 文件之间共享
+    出错时抛出异常，原文件和已有的备份都不会被改动
+    """
     print(f"正在处理: {xp3_path}")
 
-    # 创建临时目录
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_path = Path(temp_dir)
-
-        # 解包 XP3
-        print("正在解包...")
-        with XP3(str(xp3_path), "r", silent=True) as xp3:
-            xp3.extract(to=str(temp_path), encryption_type=encryption)
-
-        # 处理音频文件
-        print("正在处理音频文件...")
-        process_audio_files(temp_path, speed)
-
-        # 备份原文件
-        backup_path = xp3_path.with_suffix(".xp3.bak")
+    # 先写到同目录的临时文件，成功后才替换原文件，出错时原文件保持不变
+    temp_path = xp3_path.with_suffix(".xp3.tmp")
+    print("正在处理音频文件并重新打包...")
+    speedup = AudioSpeedup(speed, cache, stats)
+    try:
+        # 音频在线程池中并发处理，其余文件原样复制
+        with XP3(str(xp3_path), "r", silent=True, use_mmap=True, encryption=encryption, stats=stats) as src, \
+                XP3(str(temp_path), "w", silent=True, compressed=True, encryption=encryption, stats=stats) as dst:
+            XP3.transform(
+                src,
+                dst,
+                lambda name: name.lower().endswith(".ogg"),
+                speedup,
+                executor,
+                depth,
+                budget,
+            )
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    speedup.report()
+
+    # 备份原文件，已有的备份不覆盖（它才是最早的原文件）
+    backup_path = xp3_path.with_suffix(".xp3.bak")
+    if backup_path.exists():
+        print(f"备份已存在，保留: {backup_path}")
+    else:
         print(f"备份原文件到: {backup_path}")
-        shutil.move(str(xp3_path), str(backup_path))
-
-        # 重新打包
-        print("正在重新打包...")
-        with XP3(str(xp3_path), "w", silent=True, compressed=True) as xp3:
-            xp3.add_folder(str(temp_path))
+        backup(xp3_path, backup_path)
+    os.replace(temp_path, xp3_path)
 
     print(f"完成处理: {xp3_path}\n")
 
 
+def backup(path: Path, backup_path: Path):
+    """不移动原文件地复制一份备份，能用硬链接时不复制数据，backup_path 已存在时抛出 FileExistsError"""
+    try:
+        os.link(path, backup_path)
+    except FileExistsError:
+        raise
+    except OSError:  # 文件系统不支持硬链接
+        with open(path, "rb") as source, open(backup_path, "xb") as target:
+            shutil.copyfileobj(source, target)
+        shutil.copystat(path, backup_path)
+
+
 def main():
     parser = argparse.ArgumentParser(description="批量处理 XP3 文件中的音频")
     parser.add_argument("folder", type=str, help="包含 XP3 文件的文件夹路径")
     parser.add_argument(
-        "--encryption", "-e", type=str, default="none", help="XP3 文件的加密方式"
+        "--encryption",
+        "-e",
+        type=str,
+        default="none",
+        choices=game_list.keys(),
+        help="XP3 文件的加密方式",
     )
     parser.add_argument(
         "--speed", "-s", type=float, default=1.5, help="音频加速倍率 (默认: 1.5)"
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="同时运行的 ffmpeg 数量，所有 XP3 文件共享 (默认: CPU 核心数)",
+    )
+    parser.add_argument(
+        "--archives",
+        "-a",
+        type=int,
+        default=2,
+        help="同时处理的 XP3 文件数量 (默认: 2)",
+    )
+    parser.add_argument(
+        "--memory",
+        "-m",
+        type=int,
+        default=1024,
+        help="所有 XP3 文件共享的待处理音频内存上限，单位 MB (默认: 1024)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="转码结果缓存目录，重复运行时跳过已处理过的音频 (默认: 不缓存)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=4096,
+        help="转码缓存大小上限，超出时删除最久未使用的结果，单位 MB (默认: 4096)",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="结束时打印各阶段 (读取、解压、解密、转码、压缩、写入等) 的耗时和 MB/s",
+    )
 
     args = parser.parse_args()
     folder_path = Path(args.folder)
@@ -87,8 +188,56 @@ def main():
         return
 
     print(f"找到 {len(xp3_files)} 个 XP3 文件")
-    for xp3_file in xp3_files:
-        process_xp3(xp3_file, args.encryption, args.speed)
+    cache = DiskCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+    stats = Stats() if args.stats else None
+    failed = schedule(
+        xp3_files, args.encryption, args.speed, args.jobs, args.archives, args.memory * 1024 * 1024, cache, stats
+    )
+    if cache is not None:
+        print(f"转码缓存: 命中 {cache.hits} 个，未命中 {cache.misses} 个")
+    if stats is not None:
+        print("各阶段耗时:")
+        print(stats.report())
+    if failed:
+        print(f"{len(failed)} 个 XP3 文件处理失败:")
+        for xp3_file in failed:
+            print(f"  {xp3_file}")
+        raise SystemExit(1)
+
+
+def schedule(
+    xp3_files: list[Path],
+    encryption: str,
+    speed: float,
+    jobs: int,
+    archives: int,
+    memory: int,
+    cache: DiskCache = None,
+    stats: Stats = None,
+) -> dict[Path, Exception]:
+    """
+    同时处理多个 XP3 文件，从最大的开始以缩短总时间，
+    所有文件共享同一个 ffmpeg 线程池和内存预算，避免 CPU 和磁盘过载
+    一个文件失败不影响其他文件，返回失败的文件和它们的异常
+    """
+    # 大文件先开始，小文件填补空闲
+    xp3_files = sorted(xp3_files, key=lambda path: path.stat().st_size, reverse=True)
+    budget = ByteBudget(memory)
+    with ThreadPoolExecutor(jobs) as executor, ThreadPoolExecutor(max(1, archives)) as archive_executor:
+        futures = {
+            archive_executor.submit(
+                process_xp3, xp3_file, encryption, speed, executor, jobs * 2, budget, cache, stats
+            ): xp3_file
+            for xp3_file in xp3_files
+        }
+        failed = {}
+        for future, xp3_file in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"处理 {xp3_file} 失败 ({type(e).__name__}): {e}，原文件未改动")
+                failed[xp3_file] = e
+    return failed
 
 
 if __name__ == "__main__":
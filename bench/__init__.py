@@ -0,0 +1,12 @@
+"""Offline benchmarks for the xp3 hot paths"""
+import time
+
+
+def best_of(function, repeat: int) -> float:
+    """Best time out of `repeat` runs of function()"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,226 @@
+"""
+Benchmark suite of the xp3 hot paths, runs offline on synthetic data
+Usage::
+    python -m bench --files 2000 --size 64 --encryption neko_vol0 --json results.json
+    python -m bench --quick
+Every result is a (name, value, unit) row, the JSON output also records the settings and versions
+so results of different versions can be compared
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+
+from bench import best_of
+from bench.index_parse import make_index
+from bench.synthetic import make_archive, make_folder, parse_mix, file_types
+from structs import XP3FileIndex
+from structs.game_list import game_list
+from xp3 import XP3
+
+
+def megabytes_per_second(size: int, elapsed: float) -> float:
+    return size / elapsed / 1e6 if elapsed else float('inf')
+
+
+def bench_index(args) -> list:
+    """File index parse and serialise, entries/s"""
+    index = make_index(args.entries)
+    parsed = XP3FileIndex.from_index(index)
+    results = [
+        ('index.parse', args.entries / best_of(lambda: XP3FileIndex.from_index(index), args.repeat), 'entries/s'),
+        ('index.parse_entries', args.entries / best_of(lambda: XP3FileIndex.parse(index), args.repeat), 'entries/s'),
+        ('index.serialise', args.entries / best_of(lambda: parsed.to_bytes(False), args.repeat), 'entries/s'),
+        ('index.serialise_compressed', args.entries / best_of(lambda: parsed.to_bytes(True), args.repeat),
+         'entries/s'),
+    ]
+    return results
+
+
+def bench_read(args, archive: Path, total: int) -> list:
+    """XP3File.read of every file, and its decompress and decrypt phases on their own, MB/s of file data"""
+    with XP3(str(archive), 'r', silent=True, encryption=args.encryption, use_mmap=True) as xp3:
+        files = list(xp3)
+        stored = [file.read_segments() for file in files]
+
+        def read():
+            for file in files:
+                file.read(args.encryption, encrypt_instance=xp3.encrypt_instance)
+
+        def decompress():
+            for file, segments in zip(files, stored):
+                for segment, data in zip(file.segm, segments):
+                    if segment.is_compressed:
+                        zlib.decompress(data)
+
+        decompressed = []
+        for file, segments in zip(files, stored):
+            decompressed.append(bytearray(b''.join(zlib.decompress(data) if segment.is_compressed else data
+                                                   for segment, data in zip(file.segm, segments))))
+
+        def decrypt():
+            for file, data in zip(files, decompressed):
+                xp3.encrypt_instance.apply(data, file.adler32)
+
+        def checksum():
+            for data in decompressed:
+                zlib.adler32(data)
+
+        results = [
+            ('read', megabytes_per_second(total, best_of(read, args.repeat)), 'MB/s'),
+            ('read.segments', megabytes_per_second(total, best_of(lambda: [file.read_segments() for file in files],
+                                                                  args.repeat)), 'MB/s'),
+            ('read.decompress', megabytes_per_second(total, best_of(decompress, args.repeat)), 'MB/s'),
+            ('read.checksum', megabytes_per_second(total, best_of(checksum, args.repeat)), 'MB/s'),
+        ]
+        if xp3.is_encrypted:
+            results.append(('read.decrypt', megabytes_per_second(total, best_of(decrypt, args.repeat)), 'MB/s'))
+        return results
+
+
+def bench_extract(args, archive: Path, total: int, folder: Path) -> list:
+    """XP3.extract of the whole archive, serial and with workers, MB/s of file data"""
+    results = []
+    for workers in sorted({1, args.workers}):
+        output = folder / 'extract'
+
+        def extract():
+            shutil.rmtree(output, ignore_errors=True)
+            with XP3(str(archive), 'r', silent=True, encryption=args.encryption, use_mmap=True,
+                     workers=workers) as xp3:
+                xp3.extract(str(output), args.encryption)
+
+        results.append(('extract.workers_{}'.format(workers),
+                        megabytes_per_second(total, best_of(extract, args.repeat)), 'MB/s'))
+    return results
+
+
+def bench_pack(args, folder: Path, total: int) -> list:
+    """XP3.add_folder of the synthetic game, serial and with workers, MB/s of file data"""
+    results = []
+    archive = folder.parent / 'pack.xp3'
+    for workers in sorted({1, args.workers}):
+        def pack():
+            with XP3(str(archive), 'w', silent=True, encryption=args.encryption, workers=workers) as xp3:
+                xp3.add_folder(str(folder))
+
+        results.append(('add_folder.workers_{}'.format(workers),
+                        megabytes_per_second(total, best_of(pack, args.repeat)), 'MB/s'))
+    return results
+
+
+def bench_crypt(args) -> list:
+    """encrypt_buffer of every scheme with numpy and in pure Python, MB/s, and encrypt_many of many small files"""
+    data = bytearray(os.urandom(args.crypt_size * 1024 * 1024))
+    small = [bytearray(os.urandom(512)) for _ in range(10000)]
+    results = []
+    seen = set()
+    for game_name, (crypt_class, params, _) in game_list.items():
+        encrypt_instance = crypt_class(**params)
+        if str(encrypt_instance) in seen:  # Same scheme and keys under another name
+            continue
+        seen.add(str(encrypt_instance))
+        for use_numpy in (True, False):
+            name = 'crypt.{}.{}'.format(game_name, 'numpy' if use_numpy else 'python')
+            elapsed = best_of(lambda: encrypt_instance.encrypt_buffer(data, 0x12345678, 0, use_numpy), args.repeat)
+            results.append((name, megabytes_per_second(len(data), elapsed), 'MB/s'))
+
+        def one_by_one():
+            for buffer in small:
+                encrypt_instance.encrypt_buffer(buffer, 0x12345678)
+
+        results.append(('crypt.{}.small'.format(game_name), len(small) / best_of(one_by_one, args.repeat), 'files/s'))
+        results.append(('crypt.{}.small_batch'.format(game_name),
+                        len(small) / best_of(lambda: encrypt_instance.encrypt_many((buffer, 0x12345678)
+                                                                                   for buffer in small), args.repeat),
+                        'files/s'))
+    return results
+
+
+def environment() -> dict:
+    """Versions the results depend on"""
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ModuleNotFoundError:
+        numpy_version = None
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                  cwd=Path(__file__).resolve().parent.parent).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        'revision': revision or None,
+        'python': platform.python_version(),
+        'numpy': numpy_version,
+        'zlib': zlib.ZLIB_RUNTIME_VERSION,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='xp3 benchmark suite')
+    parser.add_argument('--suites', nargs='+', default=['index', 'read', 'extract', 'pack', 'crypt'],
+                        choices=['index', 'read', 'extract', 'pack', 'crypt'])
+    parser.add_argument('--files', '-n', type=int, default=2000, help='Files in the synthetic archive')
+    parser.add_argument('--size', '-s', type=int, default=32, help='Average file size in kilobytes')
+    parser.add_argument('--mix', '-m', default='script=4,image=1,audio=2',
+                        help='File types and their weights, out of {}'.format(', '.join(file_types)))
+    parser.add_argument('--encryption', '-e', choices=game_list.keys(), default='neko_vol0')
+    parser.add_argument('--entries', type=int, default=100000, help='Entries of the synthetic file index')
+    parser.add_argument('--crypt-size', type=int, default=16, help='Megabytes encrypted per crypt run')
+    parser.add_argument('--workers', '-j', type=int, default=os.cpu_count() or 1,
+                        help='Workers of the parallel extract and pack runs')
+    parser.add_argument('--repeat', '-r', type=int, default=3, help='Runs per measure, the best one counts')
+    parser.add_argument('--quick', action='store_true', help='Small sizes and one run, to check the suite works')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+    if args.quick:
+        args.files, args.size, args.entries, args.crypt_size, args.repeat = 100, 8, 5000, 1, 1
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        if {'read', 'extract', 'pack'} & set(args.suites):
+            game = folder / 'game'
+            total = make_folder(game, args.files, args.size * 1024, parse_mix(args.mix))
+            archive = folder / 'data.xp3'
+            make_archive(archive, args.files, args.size * 1024, parse_mix(args.mix), args.encryption)
+            print('Synthetic game: {} files, {} bytes, {} encryption'.format(args.files, total, args.encryption))
+
+        for suite in args.suites:
+            if suite == 'index':
+                rows = bench_index(args)
+            elif suite == 'read':
+                rows = bench_read(args, archive, total)
+            elif suite == 'extract':
+                rows = bench_extract(args, archive, total, folder)
+            elif suite == 'pack':
+                rows = bench_pack(args, game, total)
+            else:
+                rows = bench_crypt(args)
+            for name, value, unit in rows:
+                print('{:>36}: {:14,.1f} {}'.format(name, value, unit))
+            results.extend(rows)
+
+    if args.json:
+        settings = {key: value for key, value in vars(args).items() if key != 'json'}
+        with open(args.json, 'w') as output:
+            json.dump({'environment': environment(), 'settings': settings,
+                       'results': {name: {'value': value, 'unit': unit} for name, value, unit in results}},
+                      output, indent=2)
+        print('Results written to {}'.format(args.json))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""
+Compares compressing one big file with zlib.compress against compressing it in blocks on a thread pool
+Usage::
+    python -m bench.block_compress --size 256 --workers 1 2 4 8
+"""
+import os
+import zlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import best_of
+from compression import compress_parallel
+
+
+def make_data(size: int) -> bytes:
+    """Somewhat compressible data, random runs mixed with repeated text like a movie container or a BGM pack"""
+    chunks = []
+    while sum(map(len, chunks)) < size:
+        chunks.append(os.urandom(4096))
+        chunks.append(b'KiriKiri Z %d ' % len(chunks) * 256)
+    return b''.join(chunks)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Block-parallel compression benchmark')
+    parser.add_argument('--size', '-s', type=int, default=64, help='Megabytes of data to compress')
+    parser.add_argument('--level', '-l', type=int, default=9)
+    parser.add_argument('--block-size', '-b', type=int, default=1024, help='Block size in kilobytes')
+    parser.add_argument('--workers', '-j', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    parser.add_argument('--repeat', '-r', type=int, default=3)
+    args = parser.parse_args()
+
+    data = make_data(args.size * 1024 * 1024)
+    print('Data: {} bytes, level {}, {} CPUs'.format(len(data), args.level, os.cpu_count()))
+    baseline = best_of(lambda: zlib.compress(data, args.level), args.repeat)
+    size = len(zlib.compress(data, args.level))
+    print('{:>12}: {:8.3f} s, {:8.1f} MB/s, {:12,} bytes'.format('zlib', baseline, len(data) / baseline / 1e6, size))
+    for workers in sorted(set(args.workers)):
+        with ThreadPoolExecutor(workers) as executor:
+            compress = lambda data: compress_parallel(data, args.level, executor, args.block_size * 1024)
+            elapsed = best_of(lambda: compress(data), args.repeat)
+            compressed = compress(data)
+            assert zlib.decompress(compressed) == data
+            size = len(compressed)
+        print('{:>12}: {:8.3f} s, {:8.1f} MB/s, {:12,} bytes, {:5.2f}x'.format(
+            '{} workers'.format(workers), elapsed, len(data) / elapsed / 1e6, size, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Compares the single-pass file index parser with the chunk by chunk one
+Usage::
+    python -m bench.index_parse --entries 100000
+"""
+import argparse
+from io import BytesIO
+
+from bench import best_of
+from structs import XP3FileIndex, XP3FileEntry, XP3IndexSpecialFormat, XP3FileTime, XP3FileAdler, \
+    XP3FileSegments, XP3FileInfo
+
+
+def make_index(entries: int, special_field: bytes = b'') -> bytes:
+    """Build a synthetic decompressed file index with the given amount of entries"""
+    chunks = []
+    offset = 0x20
+    for i in range(entries):
+        file_path = 'scenario/route_{}/スクリプト_{:06}.ks'.format(i % 7, i)
+        adlr = XP3FileAdler(i * 2654435761 & 0xFFFFFFFF)
+        size = 512 + i % 4096
+        segm = XP3FileSegments([XP3FileSegments.segment(True, offset, size, size // 2)])
+        info = XP3FileInfo(bool(special_field), size, size // 2, file_path)
+        special_format = XP3IndexSpecialFormat(adlr.value, file_path, special_field) if special_field else None
+        entry = XP3FileEntry(time=XP3FileTime(i * 1000), adlr=adlr, segm=segm, info=info,
+                             special_format=special_format)
+        chunks.append(entry.to_bytes())
+        offset += size // 2
+    return b''.join(chunks)
+
+
+def parse_chunks(index: bytes) -> list:
+    """The chunk by chunk parser going through XP3FileEntry.read_from"""
+    entries = []
+    with BytesIO(index) as index_buffer:
+        while index_buffer.tell() < len(index):
+            entries.append(XP3FileEntry.read_from(index_buffer))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File index parser benchmark')
+    parser.add_argument('--entries', '-n', type=int, default=100000)
+    parser.add_argument('--special', choices=['', 'eliF', 'neko'], default='',
+                        help='Prepend a maker specific chunk to every entry')
+    parser.add_argument('--repeat', '-r', type=int, default=3)
+    args = parser.parse_args()
+
+    index = make_index(args.entries, args.special.encode())
+    print('Index: {} entries, {} bytes'.format(args.entries, len(index)))
+    parsers = (
+        ('chunked', parse_chunks),
+        ('single-pass', XP3FileIndex.parse),
+        ('columnar', XP3FileIndex.from_index),  # Entries are not built until accessed
+        ('scan only', lambda data: list(XP3FileIndex.scan(data))),  # Without building the entry objects
+    )
+    for name, parse in parsers:
+        elapsed = best_of(lambda: parse(index), args.repeat)
+        print('{:>12}: {:8.3f} s, {:12,.0f} entries/s'.format(name, elapsed, args.entries / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Synthetic game folders and archives for the benchmarks, with a configurable mix of file types
+Usage::
+    python -m bench.synthetic data.xp3 --files 1000 --size 64 --mix script=4,image=1,audio=2 -e neko_vol0
+"""
+import os
+import random
+import argparse
+from pathlib import Path
+
+from structs.game_list import game_list
+
+# File type -> (extension, how compressible the content is, 0 is random noise)
+file_types = {
+    'script': ('.ks', 0.9),
+    'text': ('.txt', 0.8),
+    'image': ('.png', 0.0),
+    'tlg': ('.tlg', 0.5),
+    'audio': ('.ogg', 0.0),
+    'movie': ('.mpg', 0.05),
+}
+
+
+def parse_mix(mix: str) -> dict:
+    """'script=4,image=1' -> {'script': 4, 'image': 1}"""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in file_types:
+            raise ValueError('Unknown file type {}, one of {}'.format(name, ', '.join(file_types)))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def make_content(size: int, compressibility: float, rng: random.Random) -> bytes:
+    """Data of which about `compressibility` is made of repeated text and the rest is noise"""
+    text = 'それは、ある夏の日のこと。[r]\n@bgm storage="bgm_{:02}"\n'.format(rng.randrange(100)).encode('utf-8')
+    chunks, total = [], 0
+    while total < size:
+        chunk = text * 8 if rng.random() < compressibility else rng.randbytes(len(text) * 8)
+        chunks.append(chunk)
+        total += len(chunk)
+    return b''.join(chunks)[:size]
+
+
+def make_files(files: int, size: int, mix: dict, seed: int = 0):
+    """
+    Yields (internal file path, data) of a synthetic game
+    :param files: Number of files
+    :param size: Average size of a file in bytes, actual sizes vary from half to one and a half of it
+    :param mix: File type -> weight, see file_types
+    """
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    for i in range(files):
+        file_type = rng.choices(names, weights)[0]
+        extension, compressibility = file_types[file_type]
+        file_size = rng.randint(size // 2, size + size // 2)
+        yield '{}/{:06}{}'.format(file_type, i, extension), make_content(file_size, compressibility, rng)
+
+
+def make_folder(path: Path, files: int, size: int, mix: dict, seed: int = 0) -> int:
+    """Write a synthetic game folder, returns the number of bytes written"""
+    total = 0
+    for internal_filepath, data in make_files(files, size, mix, seed):
+        file_path = Path(path, *internal_filepath.split('/'))
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        file_path.write_bytes(data)
+        total += len(data)
+    return total
+
+
+def make_archive(path: Path, files: int, size: int, mix: dict, encryption: str = 'none', compressed: bool = True,
+                 seed: int = 0) -> int:
+    """Pack a synthetic game into an archive, returns the number of bytes of the files"""
+    from xp3 import XP3
+
+    total = 0
+    with XP3(str(path), 'w', silent=True, compressed=compressed, encryption=encryption) as xp3:
+        for internal_filepath, data in make_files(files, size, mix, seed):
+            xp3.add(internal_filepath, data)
+            total += len(data)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic XP3 archive generator')
+    parser.add_argument('output', help='Archive to write')
+    parser.add_argument('--files', '-n', type=int, default=1000)
+    parser.add_argument('--size', '-s', type=int, default=64, help='Average file size in kilobytes')
+    parser.add_argument('--mix', '-m', default='script=4,image=1,audio=2',
+                        help='File types and their weights, out of {}'.format(', '.join(file_types)))
+    parser.add_argument('--encryption', '-e', choices=game_list.keys(), default='none')
+    parser.add_argument('--store', action='store_true', help='Do not compress the files')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    total = make_archive(args.output, args.files, args.size * 1024, parse_mix(args.mix), args.encryption,
+                         not args.store, args.seed)
+    print('{}: {} files, {} bytes before packing'.format(args.output, args.files, total))
+
+
+if __name__ == '__main__':
+    main()
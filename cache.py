@@ -0,0 +1,89 @@
+"""Content-addressed on-disk cache shared between runs"""
+import os
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+
+
+class DiskCache:
+    """
+    Stores blobs under a key in a directory, evicting the least recently used ones once it grows over max_bytes
+    Entries are written to a temporary file and renamed into place, and a missing entry is just a miss,
+    so several threads or processes can share a directory
+    Usage example::
+        cache = DiskCache('cache', 1024 * 1024 * 1024)
+        key = DiskCache.key(hashlib.sha256(data).hexdigest(), 'atempo=1.5')
+        result = cache.get(key)
+        if result is None:
+            result = process(data)
+            cache.put(key, result)
+    """
+
+    def __init__(self, directory, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Builds a key out of anything with a stable repr"""
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix='.tmp', delete=False) as temp:
+            temp.write(data)
+        os.replace(temp.name, path)
+        with self._lock:
+            self._size += len(data)
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is below 90% of max_bytes"""
+        entries = sorted(self._entries())
+        size = sum(size for _, _, size in entries)
+        for _, path, entry_size in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:  # Evicted by someone else
+                pass
+            size -= entry_size
+        with self._lock:
+            self._size = size
+
+    def _entries(self):
+        """(last use, path, size) of every entry"""
+        for path in self.directory.glob('*/*'):
+            if path.name.startswith('.tmp'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            yield stat.st_mtime, path, stat.st_size
@@ -0,0 +1,188 @@
+"""Decides which files are worth compressing when packing and how hard, and compresses big ones in parallel"""
+import os
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import Executor
+
+
+class CompressionPolicy:
+    """
+    Picks a zlib level for every file added to an archive, 0 means storing it as it is
+    Usage example::
+        policy = CompressionPolicy(levels={'.ks': 9, '.tlg': 0})
+        with XP3Writer(compressed=True, policy=policy) as xp3:
+            ...
+    """
+    # Formats that are already compressed, deflating them again costs a lot of time for nothing
+    stored_extensions = (
+        '.ogg', '.opus', '.mp3', '.m4a', '.wma', '.flac',
+        '.png', '.jpg', '.jpeg', '.webp', '.jxl',
+        '.mpg', '.mpeg', '.mp4', '.wmv', '.avi', '.webm', '.mkv',
+        '.zip', '.7z', '.gz', '.xz', '.xp3',
+    )
+
+    def __init__(self,
+                 level: int = 9,
+                 large_level: int = 6,
+                 large_size: int = 16 * 1024 * 1024,
+                 levels: dict = None,
+                 probe: bool = True,
+                 probe_size: int = 16 * 1024,
+                 probe_ratio: float = 0.95):
+        """
+        :param level: Level of files without a rule for their extension
+        :param large_level: Level of files without a rule that are bigger than large_size
+        :param large_size: Size in bytes from which a file counts as large
+        :param levels: Extension (with the dot) -> level, on top of storing stored_extensions
+        :param probe: Trial compress a few samples of big files and store them if they barely shrink
+        :param probe_size: Size of each sample, files smaller than four samples are not probed
+        :param probe_ratio: Samples compressing to more than this part of their size mean the file is stored
+        """
+        self.level = level
+        self.large_level = large_level
+        self.large_size = large_size
+        self.levels = {extension: 0 for extension in self.stored_extensions}
+        self.levels.update({extension.lower(): file_level for extension, file_level in (levels or {}).items()})
+        self.probe = probe
+        self.probe_size = probe_size
+        self.probe_ratio = probe_ratio
+
+    @classmethod
+    def always(cls, level: int = 9) -> 'CompressionPolicy':
+        """Compress every file at the same level, how archives were packed before policies"""
+        policy = cls(level, level, probe=False)
+        policy.levels = {}
+        return policy
+
+    def level_for(self, internal_filepath: str, data: bytes = b'', size: int = None) -> int:
+        """
+        :param internal_filepath: Internal file path, its extension picks the rule
+        :param data: File content, or the start of it, as it is going to be compressed
+        :param size: Size of the whole file if data is only the start of it
+        :return: zlib level to compress the file with, 0 to store it
+        """
+        size = len(data) if size is None else size
+        extension = os.path.splitext(internal_filepath)[1].lower()
+        if extension in self.levels:
+            return self.levels[extension]
+        if self.probe and not self.is_compressible(data):
+            return 0
+        return self.large_level if size > self.large_size else self.level
+
+    def is_compressible(self, data: bytes) -> bool:
+        """Trial compress samples from the start, the middle and the end of data at the fastest level"""
+        size = self.probe_size
+        if len(data) < size * 4:
+            return True
+        view = memoryview(data)
+        samples = (view[:size], view[len(data) // 2:len(data) // 2 + size], view[-size:])
+        compressed = sum(len(zlib.compress(sample, level=1)) for sample in samples)
+        return compressed <= self.probe_ratio * size * len(samples)
+
+
+_ADLER_BASE = 65521
+_WINDOW = 32 * 1024  # Deflate window, how much of the previous block is used as dictionary
+
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """Adler-32 of two pieces of data joined together, from the checksums of both and the length of the second one"""
+    remainder = length2 % _ADLER_BASE
+    sum1 = adler1 & 0xFFFF
+    sum2 = remainder * sum1 % _ADLER_BASE
+    sum1 += (adler2 & 0xFFFF) + _ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + _ADLER_BASE - remainder
+    return sum1 % _ADLER_BASE | (sum2 % _ADLER_BASE) << 16
+
+
+def compress_block(block: bytes, level: int, dictionary: bytes = b'') -> tuple[bytes, int]:
+    """
+    Raw deflate a block ending with a sync flush, so blocks compressed on their own can be joined
+    :param dictionary: Data right before the block, primes the window so matches can reach back into it
+    :return: Compressed block and its Adler-32
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH), zlib.adler32(block)
+
+
+class BlockCompressor:
+    """
+    Compresses data in blocks on an executor and joins them into a single zlib stream, like pigz does,
+    any zlib reader (the KiriKiri runtime too) sees an ordinary stream
+    Has the compress/flush interface of zlib.compressobj
+    Usage example::
+        with ThreadPoolExecutor(4) as executor:
+            compressor = BlockCompressor(9, executor)
+            data = compressor.compress(data) + compressor.flush()
+    """
+
+    def __init__(self, level: int, executor: Executor, block_size: int = 1024 * 1024, depth: int = None):
+        """
+        :param level: zlib level
+        :param executor: Executor the blocks are compressed on
+        :param block_size: Size of the blocks, each one costs a few bytes of flush markers
+        :param depth: How many blocks may be compressed ahead of the output, twice the pool size by default
+        """
+        self.level = level
+        self.executor = executor
+        self.block_size = block_size
+        self.depth = depth or 2 * getattr(executor, '_max_workers', 4)
+        self._input = bytearray()
+        self._dictionary = b''
+        self._pending = deque()
+        self._adler32 = 1
+        self._started = False
+
+    def compress(self, data) -> bytes:
+        """Queue data, returns the compressed blocks finished so far"""
+        output = []
+        view = memoryview(data)
+        if self._input:  # Complete the block left over from the last call first
+            missing = self.block_size - len(self._input)
+            self._input += view[:missing]
+            view = view[missing:]
+            if len(self._input) == self.block_size:
+                output.append(self._submit(bytes(self._input)))
+                self._input.clear()
+        # Whole blocks are compressed straight out of data without copying them
+        while len(view) >= self.block_size:
+            output.append(self._submit(view[:self.block_size]))
+            view = view[self.block_size:]
+        self._input += view
+        return b''.join(output)
+
+    def flush(self) -> bytes:
+        """Compress what is left and end the stream"""
+        output = self._submit(bytes(self._input)) if self._input else b''
+        self._input.clear()
+        output += self._collect(0)
+        # An empty final block and the checksum of all blocks
+        return output + zlib.compressobj(self.level, zlib.DEFLATED, -15).flush() + struct.pack('>I', self._adler32)
+
+    def _submit(self, block) -> bytes:
+        """Queue a block, returns the blocks finished so far"""
+        self._pending.append((len(block), self.executor.submit(compress_block, block, self.level, self._dictionary)))
+        self._dictionary = block[-_WINDOW:]
+        return self._collect(self.depth)
+
+    def _collect(self, depth: int) -> bytes:
+        """Join the finished blocks in order, waiting for the oldest ones while more than depth are queued"""
+        output = []
+        if not self._started:
+            output.append(zlib.compress(b'', self.level)[:2])  # zlib header for the level
+            self._started = True
+        while self._pending and (len(self._pending) > depth or self._pending[0][1].done()):
+            size, future = self._pending.popleft()
+            block, adler32 = future.result()
+            self._adler32 = adler32_combine(self._adler32, adler32, size)
+            output.append(block)
+        return b''.join(output)
+
+
+def compress_parallel(data: bytes, level: int, executor: Executor, block_size: int = 1024 * 1024) -> bytes:
+    """zlib.compress on an executor, one block_size block per task"""
+    compressor = BlockCompressor(level, executor, block_size)
+    return compressor.compress(data) + compressor.flush()
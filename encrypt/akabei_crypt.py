@@ -1,9 +1,9 @@
-from io import BytesIO
 from .encrypt_interface import EncryptInterface
+from .xor import xor_keystream, xor_many
 import binascii
 
 try:
-    from numpy import frombuffer, uint8, bitwise_and, bitwise_xor, right_shift, concatenate
+    from numpy import array, empty, uint8, uint64
 
     numpy = True
 except ModuleNotFoundError:
@@ -17,28 +17,24 @@ class AkabeiCrypt(EncryptInterface):
         super().__init__(**kwargs)
         self.m_seed = kwargs['m_seed']
 
-    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        buffer.seek(0)
-        data = buffer.read()
-        data = bytearray(data)
+    def encrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
         keystream = self.__gen_keystream(adler32)
-        keystream = (keystream * (len(data)//len(keystream) + 1))[:len(data)]
+        # The keystream repeats every 32 bytes of the file, start it where the buffer is
+        keystream = keystream[offset % len(keystream):] + keystream[:offset % len(keystream)]
+        xor_keystream(buffer, bytes(keystream), use_numpy)
 
-        if numpy and use_numpy:
-            data = frombuffer(data, dtype=uint8)
-            keystream = frombuffer(keystream, dtype=uint8)
-            data = bitwise_xor(data, keystream)
-            data = data.tobytes()
+    def decrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        self.encrypt_buffer(buffer, adler32, offset, use_numpy)
 
-        else:
-            for i in range(len(data)):
-                data[i] ^= keystream[i]
+    def encrypt_many(self, items, use_numpy=True):
+        batch = self._batch(items)
+        if not (numpy and use_numpy and batch):
+            return super().encrypt_many(batch, use_numpy)
+        views, adler32s, offsets = zip(*batch)
+        xor_many(list(views), self.__gen_keystreams(array(adler32s, dtype=uint64)), offsets)
 
-        buffer.seek(0)
-        buffer.write(data)
-
-    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        self.encrypt(buffer, adler32, use_numpy)
+    def decrypt_many(self, items, use_numpy=True):
+        self.encrypt_many(items, use_numpy)
 
     def __str__(self):
         return f'{self.__class__.__name__} ({binascii.hexlify(self.m_seed.to_bytes(4, byteorder="little"))})'
@@ -51,3 +47,13 @@ class AkabeiCrypt(EncryptInterface):
             result.append(adler32 & 0xFF)
             adler32 = (adler32 & 0xFFFFFFFE) << 23 | adler32 >> 8
         return result
+
+    def __gen_keystreams(self, adler32s):
+        """__gen_keystream of many checksums at once, one keystream per row"""
+        keystreams = empty((len(adler32s), 0x20), dtype=uint8)
+        adler32s = (adler32s ^ uint64(self.m_seed)) & uint64(0x7FFFFFFF)
+        adler32s = adler32s << uint64(31) | adler32s
+        for i in range(0x20):
+            keystreams[:, i] = adler32s & uint64(0xFF)
+            adler32s = (adler32s & uint64(0xFFFFFFFE)) << uint64(23) | adler32s >> uint64(8)
+        return keystreams
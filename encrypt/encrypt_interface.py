@@ -1,21 +1,111 @@
+import inspect
 from io import BytesIO
+from functools import lru_cache
 
 
 class EncryptInterface:
-    """基礎加解密介面，"""
+    """
+    基礎加解密介面，
+    子類實作 encrypt_buffer/decrypt_buffer（就地處理，不複製）或舊的 BytesIO 介面 encrypt/decrypt 其中一組即可，
+    另一組會自動轉接
+    """
 
     def __init__(self, **kwargs):
         """初始化介面，比如說傳遞密鑰🔐參數"""
         pass
 
-    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        """基礎加密介面，你需要 derive 🔐然後對 buffer 進行加密"""
-        pass
+    def encrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        """
+        就地加密可寫的 buffer（bytearray、memoryview、numpy array 等支援 buffer protocol 的物件）
+        :param offset: buffer 第一個 byte 在檔案中的位置，用來分塊加密
+        """
+        if type(self).encrypt is not EncryptInterface.encrypt:
+            self._through_bytesio(self.encrypt, buffer, adler32, offset, use_numpy)
 
-    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        """基礎解密介面，你需要 derive 🔐然後對 buffer 進行解密"""
-        pass
+    def decrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        """
+        就地解密可寫的 buffer，見 encrypt_buffer
+        :param offset: buffer 第一個 byte 在檔案中的位置，用來分塊解密
+        """
+        if type(self).decrypt is not EncryptInterface.decrypt:
+            self._through_bytesio(self.decrypt, buffer, adler32, offset, use_numpy)
+
+    def apply(self, buffer, adler32: int, file_offset: int = 0, use_numpy=True):
+        """
+        就地加密或解密檔案中從 file_offset 開始的任意一段，
+        檔案怎麼切成段都和一次處理整個檔案的結果相同，所以可以串流或在多個執行緒中分段處理
+        目前的方案都是 XOR，加密和解密相同；不是這樣的方案需要覆寫 apply 或不支援它
+        """
+        self.encrypt_buffer(buffer, adler32, file_offset, use_numpy)
+
+    def encrypt_many(self, items, use_numpy=True):
+        """
+        批次就地加密多個 buffer，items 是 (buffer, adler32) 或 (buffer, adler32, offset)，
+        有 numpy 時子類可以一次產生所有密鑰並在同一次 XOR 中處理，大量小檔案時比逐個呼叫 encrypt_buffer 快
+        """
+        for buffer, adler32, offset in self._batch(items):
+            self.encrypt_buffer(buffer, adler32, offset, use_numpy)
+
+    def decrypt_many(self, items, use_numpy=True):
+        """批次就地解密多個 buffer，見 encrypt_many"""
+        for buffer, adler32, offset in self._batch(items):
+            self.decrypt_buffer(buffer, adler32, offset, use_numpy)
+
+    @staticmethod
+    def _batch(items) -> list:
+        """把 encrypt_many 的參數統一成 (byte memoryview, adler32, offset)"""
+        return [(memoryview(buffer).cast('B'), adler32, offset[0] if offset else 0)
+                for buffer, adler32, *offset in items]
+
+    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False, offset: int = 0):
+        """
+        基礎加密介面，你需要 derive 🔐然後對 buffer 進行加密
+        :param offset: buffer 第一個 byte 在檔案中的位置，用來分塊加密
+        """
+        if type(self).encrypt_buffer is not EncryptInterface.encrypt_buffer:
+            self._through_buffer(self.encrypt_buffer, buffer, adler32, offset, use_numpy)
+
+    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False, offset: int = 0):
+        """
+        基礎解密介面，你需要 derive 🔐然後對 buffer 進行解密
+        :param offset: buffer 第一個 byte 在檔案中的位置，用來分塊解密
+        """
+        if type(self).decrypt_buffer is not EncryptInterface.decrypt_buffer:
+            self._through_buffer(self.decrypt_buffer, buffer, adler32, offset, use_numpy)
+
+    @staticmethod
+    def _through_bytesio(method, buffer, adler32: int, offset: int, use_numpy: bool):
+        """
+        用舊的 BytesIO 介面處理可寫的 buffer，
+        舊介面是 encrypt(buffer, adler32, use_numpy)，只有 offset 不為 0 時才傳入 offset，不接受它的子類無法分塊處理
+        """
+        if offset and not _accepts_offset(getattr(method, '__func__', method)):
+            raise NotImplementedError(f'{method.__qualname__} 不接受 offset 參數，'
+                                      f'無法從檔案中間（位置 {offset}）開始處理，請實作 encrypt_buffer/decrypt_buffer')
+        with memoryview(buffer) as view, view.cast('B') as view, BytesIO(view) as file_buffer:
+            if offset:
+                method(file_buffer, adler32, use_numpy, offset)
+            else:
+                method(file_buffer, adler32, use_numpy)
+            view[:] = file_buffer.getbuffer()
+
+    @staticmethod
+    def _through_buffer(method, file_buffer: BytesIO, adler32: int, offset: int, use_numpy: bool):
+        """用就地處理的介面處理 BytesIO，直接改寫它的內容"""
+        with file_buffer.getbuffer() as view:
+            method(view, adler32, offset, use_numpy)
 
     def __str__(self) -> str:
         """用來描述這個加密算法的字符串"""
         return f'{self.__class__.__name__} 基礎加解密介面'
+
+
+@lru_cache(maxsize=None)
+def _accepts_offset(function) -> bool:
+    """舊介面的 encrypt/decrypt 能否接受第四個參數 offset"""
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):  # 無法檢查的函數，直接呼叫
+        return True
+    return any(parameter.name == 'offset' or parameter.kind is inspect.Parameter.VAR_POSITIONAL
+               for parameter in parameters)
@@ -1,9 +1,8 @@
-from io import BytesIO
-
 from .encrypt_interface import EncryptInterface
+from .xor import xor_byte, xor_many
 
 try:
-    from numpy import frombuffer, uint8, bitwise_and, bitwise_xor, right_shift, concatenate
+    from numpy import array, uint8
 
     numpy = True
 except ModuleNotFoundError:
@@ -16,30 +15,22 @@ class HashCrypt(EncryptInterface):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        buffer.seek(0)
-        data = buffer.read()
-        data = bytearray(data)
-
-        key = adler32 & 0xFF
-
-        if numpy and use_numpy:
-            keystream = frombuffer(bytes([key] * len(data)), dtype=uint8)
-            data = frombuffer(data, dtype=uint8)
-            keystream = frombuffer(keystream, dtype=uint8)
-            data = bitwise_xor(data, keystream)
-            data = data.tobytes()
-
-        else:
-            for i in range(len(data)):
-                data[i] ^= key
+    def encrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        xor_byte(buffer, adler32 & 0xFF, use_numpy)
 
-        buffer.seek(0)
-        buffer.write(data)
+    def decrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        self.encrypt_buffer(buffer, adler32, offset, use_numpy)
 
-    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        self.encrypt(buffer, adler32, use_numpy)
+    def encrypt_many(self, items, use_numpy=True):
+        batch = self._batch(items)
+        if not (numpy and use_numpy and batch):
+            return super().encrypt_many(batch, use_numpy)
+        views, adler32s, offsets = zip(*batch)
+        keys = (array(adler32s, dtype='u4') & 0xFF).astype(uint8)
+        xor_many(list(views), keys.reshape(-1, 1), offsets)
 
+    def decrypt_many(self, items, use_numpy=True):
+        self.encrypt_many(items, use_numpy)
 
     def __str__(self):
         return self.__class__.__name__
@@ -1,9 +1,8 @@
-from io import BytesIO
 from .encrypt_interface import EncryptInterface
-from array import array
+from .xor import xor_byte, xor_many
 
 try:
-    from numpy import frombuffer, uint8, bitwise_and, bitwise_xor, right_shift, concatenate
+    from numpy import array, uint8, where
     numpy = True
 except ModuleNotFoundError:
     numpy = False
@@ -20,65 +19,54 @@ class NekoCrypt(EncryptInterface):
         self.sub_key = kwargs['sub_key']
         self.xor_first_byte = kwargs['xor_first_byte']
 
-    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        self.__xor(buffer, adler32, use_numpy)
+    def encrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        self.__xor(buffer, adler32, use_numpy, offset)
 
-    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
-        self.__xor(buffer, adler32, use_numpy)
+    def decrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
+        self.__xor(buffer, adler32, use_numpy, offset)
 
-    def __str__(self):
-        return f'{self.__class__.__name__} ({self.master_key}, {self.sub_key}, {"xor first byte" if self.xor_first_byte else ""})'
-
-    def __xor(self, output_buffer, adler32: int, use_numpy: bool = True):
-        """XOR the data, uses numpy if available"""
-        master_key, secondary_key, xor_the_first_byte = self.master_key, self.sub_key, self.xor_first_byte
-        # Read the encrypted data from buffer
-        output_buffer.seek(0)
-        data = output_buffer.read()
-
-        # Use numpy if available
-        if numpy and use_numpy:
-            # Calculate the XOR key
-            adler_key = bitwise_xor(adler32, master_key)
-            xor_key = bitwise_and(bitwise_xor(
-                bitwise_xor(bitwise_xor(right_shift(adler_key, 24), right_shift(adler_key, 16)),
-                            right_shift(adler_key, 8)), adler_key), 0xFF)
-            if not xor_key:
-                xor_key = secondary_key
-
-            data = frombuffer(data, dtype=uint8)
+    def encrypt_many(self, items, use_numpy=True):
+        self.__xor_many(items, use_numpy)
 
-            if xor_the_first_byte:
-                first_byte_key = bitwise_and(adler_key, 0xFF)
-                if not first_byte_key:
-                    first_byte_key = bitwise_and(master_key, 0xFF)
-                # Split the first byte into separate array
-                first = frombuffer(data[:1], dtype=uint8)
-                rest = frombuffer(data[1:], dtype=uint8)
-                # XOR the first byte
-                first = bitwise_xor(first, first_byte_key)
-                # Concatenate the array back
-                data = concatenate((first, rest))
+    def decrypt_many(self, items, use_numpy=True):
+        self.__xor_many(items, use_numpy)
 
-            data = bitwise_xor(data, xor_key)
-        else:
-            adler_key = adler32 ^ master_key
-            xor_key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
-            if not xor_key:
-                xor_key = secondary_key
-
-            data = array('B', data)
-
-            if xor_the_first_byte:
-                first_byte_key = adler_key & 0xFF
-                if not first_byte_key:
-                    first_byte_key = master_key & 0xFF
-                data[0] ^= first_byte_key
-
-            # XOR the data
-            for index in range(len(data)):
-                data[index] ^= xor_key
+    def __str__(self):
+        return f'{self.__class__.__name__} ({self.master_key}, {self.sub_key}, {"xor first byte" if self.xor_first_byte else ""})'
 
-        # Overwrite the buffer with decrypted/encrypted data
-        output_buffer.seek(0)
-        output_buffer.write(data.tobytes())
\ No newline at end of file
+    def __xor(self, buffer, adler32: int, use_numpy: bool = True, offset: int = 0):
+        """XOR the buffer in place"""
+        # Calculate the XOR key
+        adler_key = adler32 ^ self.master_key
+        xor_key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
+        if not xor_key:
+            xor_key = self.sub_key
+        first_byte_key = adler_key & 0xFF
+        if not first_byte_key:
+            first_byte_key = self.master_key & 0xFF
+
+        view = memoryview(buffer).cast('B')
+        if not len(view):
+            return
+        # Only the first byte of the file gets the extra key, not the first byte of every chunk
+        if self.xor_first_byte and offset == 0:
+            view[0] ^= first_byte_key
+
+        xor_byte(view, xor_key, use_numpy)
+
+    def __xor_many(self, items, use_numpy: bool = True):
+        """XOR many buffers in place, with the keys of all of them computed at once"""
+        batch = self._batch(items)
+        if not (numpy and use_numpy and batch):
+            return EncryptInterface.encrypt_many(self, batch, use_numpy)
+        views, adler32s, offsets = zip(*batch)
+        adler_keys = array(adler32s, dtype='u4') ^ self.master_key
+        xor_keys = (adler_keys >> 24 ^ adler_keys >> 16 ^ adler_keys >> 8 ^ adler_keys) & 0xFF
+        xor_keys = where(xor_keys == 0, self.sub_key, xor_keys).astype(uint8)
+        if self.xor_first_byte:
+            first_byte_keys = adler_keys & 0xFF
+            first_byte_keys = where(first_byte_keys == 0, self.master_key & 0xFF, first_byte_keys)
+            for view, offset, first_byte_key in zip(views, offsets, first_byte_keys.tolist()):
+                if offset == 0 and len(view):
+                    view[0] ^= first_byte_key
+        xor_many(list(views), xor_keys.reshape(-1, 1), offsets)
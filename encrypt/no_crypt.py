@@ -1,5 +1,3 @@
-from io import BytesIO
-
 from .encrypt_interface import EncryptInterface
 
 
@@ -7,10 +5,10 @@ class NoCrypt(EncryptInterface):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-    def encrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
+    def encrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
         return
 
-    def decrypt(self, buffer: BytesIO, adler32: int, use_numpy=False):
+    def decrypt_buffer(self, buffer, adler32: int, offset: int = 0, use_numpy=True):
         return
 
     def __str__(self):
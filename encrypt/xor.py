@@ -0,0 +1,123 @@
+"""
+XOR helpers shared by the crypt schemes, with numpy if available and a pure Python fallback
+(bytes.translate for a single byte key, big integer XOR for keystreams), which is still about 13x slower
+than numpy for a single byte key and 5x slower for keystreams
+"""
+try:
+    from numpy import frombuffer, uint8, bitwise_xor, array, arange, cumsum, int32, int64, repeat
+    numpy = True
+except ModuleNotFoundError:
+    numpy = False
+
+# Bytes handled at once by the pure Python XOR, a multiple of any keystream length used,
+# small enough for the copies of a chunk to stay in the CPU cache (1 MiB chunks were up to twice as slow)
+_CHUNK = 256 * 1024
+
+_tables = {}
+
+
+def xor_byte(buffer, key: int, use_numpy: bool = True):
+    """XOR every byte of a writable buffer with key, in place"""
+    view = memoryview(buffer).cast('B')
+    if numpy and use_numpy:
+        data = frombuffer(view, dtype=uint8)
+        # Keep the key uint8, a Python or int64 key would promote the whole array to int64
+        bitwise_xor(data, uint8(key), out=data)
+        return
+    table = _tables.get(key)
+    if table is None:
+        table = _tables[key] = bytes(byte ^ key for byte in range(256))
+    for start in range(0, len(view), _CHUNK):
+        chunk = view[start:start + _CHUNK]
+        chunk[:] = chunk.tobytes().translate(table)
+
+
+def xor_keystream(buffer, keystream: bytes, use_numpy: bool = True):
+    """XOR a writable buffer in place with keystream repeated over it, the keystream starts at the first byte"""
+    view = memoryview(buffer).cast('B')
+    period = len(keystream)
+    if numpy and use_numpy:
+        data = frombuffer(view, dtype=uint8)
+        keystream = frombuffer(keystream, dtype=uint8)
+        # XOR every whole period as a row of a matrix, then the rest
+        whole = len(data) - len(data) % period
+        rows = data[:whole].reshape(-1, period)
+        bitwise_xor(rows, keystream, out=rows)
+        bitwise_xor(data[whole:], keystream[:len(data) - whole], out=data[whole:])
+        return
+    # One big integer XOR per chunk, chunks are whole periods so every one starts with the keystream
+    if not len(view):
+        return
+    chunk_size = period * min(_CHUNK // period, -(-len(view) // period))
+    tiled = int.from_bytes(bytes(keystream) * (chunk_size // period), 'little')
+    for start in range(0, len(view), chunk_size):
+        chunk = view[start:start + chunk_size]
+        size = len(chunk)
+        key = tiled if size == chunk_size else tiled & ((1 << size * 8) - 1)
+        chunk[:] = (int.from_bytes(chunk, 'little') ^ key).to_bytes(size, 'little')
+
+
+# Bytes of buffers XORed together by xor_many, bounds the index arrays it builds
+_BATCH = 4 * 1024 * 1024
+# Buffers bigger than this are XORed on their own by xor_many, with a single byte key or a keystream,
+# past that the index arithmetic of the batch costs more than a call per buffer
+_SMALL = 2048
+_SMALL_KEYSTREAM = 256
+
+
+def xor_many(views: list, keystreams, offsets: list):
+    """
+    XOR many buffers in place with numpy, each with its own keystream repeated over it,
+    in one pass over their concatenation instead of one call per buffer
+    :param views: Writable byte memoryviews
+    :param keystreams: uint8 array of one keystream per buffer, all of the same length
+    :param offsets: Position of the keystream each buffer starts at
+    """
+    period = keystreams.shape[1]
+    # Big buffers gain nothing from being batched, they go one by one
+    small = []
+    limit = _SMALL if period == 1 else _SMALL_KEYSTREAM
+    for index, view in enumerate(views):
+        if len(view) <= limit:
+            small.append(index)
+        elif period == 1:
+            xor_byte(view, int(keystreams[index, 0]))
+        else:
+            shift = offsets[index] % period
+            xor_keystream(view, keystreams[index, shift:].tobytes() + keystreams[index, :shift].tobytes())
+    if len(small) < len(views):
+        views, keystreams, offsets = [views[i] for i in small], keystreams[small], [offsets[i] for i in small]
+
+    start = 0
+    while start < len(views):
+        # Take buffers until the batch is full, at least one
+        end, size = start + 1, len(views[start])
+        while end < len(views) and size + len(views[end]) <= _BATCH:
+            size += len(views[end])
+            end += 1
+
+        group = views[start:end]
+        joined = bytearray().join(group)
+        data = frombuffer(joined, dtype=uint8)
+        lengths = array([len(view) for view in group], dtype=int64)
+        if period == 1:
+            key = repeat(keystreams[start:end, 0], lengths)
+        else:
+            # Position of every byte in the keystream of its own buffer, as an index into all keystreams
+            # (int32 is enough for a batch, the row is added on top of the column so both fit in one pass)
+            first = cumsum(lengths) - lengths
+            shift = (array(offsets[start:end], dtype=int64) - first) % period
+            positions = arange(len(data), dtype=int32)
+            positions += repeat(shift.astype(int32), lengths)
+            positions %= period
+            positions += repeat(arange(0, (end - start) * period, period, dtype=int32), lengths)
+            key = keystreams[start:end].ravel().take(positions)
+        bitwise_xor(data, key, out=data)
+
+        joined = memoryview(joined)
+        position = 0
+        for view in group:
+            view[:] = joined[position:position + len(view)]
+            position += len(view)
+        del data, joined
+        start = end
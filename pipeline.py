@@ -0,0 +1,83 @@
+"""Small helpers to overlap I/O and CPU work while keeping results in order"""
+import queue
+import threading
+from concurrent.futures import Executor, Future
+
+_done = object()
+
+
+def ordered(items, work, executor: Executor, depth: int):
+    """
+    Pulls items on a reader thread, runs work(item) on the executor and yields (item, future) in the original order
+    Usage example::
+        with ThreadPoolExecutor(4) as executor:
+            for file, future in ordered(files, decode, executor, 8):
+                write(file, future.result())
+    :param items: Iterable of items, iterated on its own thread (e.g. reading segments from the archive)
+    :param work: Function to run on the executor for every item
+    :param executor: Executor to run the work on
+    :param depth: Maximum number of items read ahead of the consumer, bounds the memory in flight
+    """
+    pending = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def read():
+        try:
+            for item in items:
+                if stop.is_set():
+                    break
+                pending.put((item, executor.submit(work, item)))
+        except BaseException as e:
+            failed = Future()
+            failed.set_exception(e)
+            pending.put((_done, failed))
+        else:
+            pending.put((_done, None))
+
+    reader = threading.Thread(target=read, name='xp3-reader', daemon=True)
+    reader.start()
+    try:
+        while True:
+            item, future = pending.get()
+            if item is _done:
+                if future is not None:
+                    future.result()  # Raise whatever stopped the reader
+                break
+            yield item, future
+    finally:
+        stop.set()
+        # Unblock the reader if the consumer stopped early
+        while reader.is_alive():
+            try:
+                pending.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+class ByteBudget:
+    """
+    Shared limit on the bytes held by concurrent work, acquire blocks while the budget is used up
+    Usage example::
+        budget.acquire(len(data))
+        try:
+            process(data)
+        finally:
+            budget.release(len(data))
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size: int):
+        with self._condition:
+            # Something bigger than the whole budget still goes through once nothing else is held
+            self._condition.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+
+    def release(self, size: int):
+        with self._condition:
+            self.used -= size
+            self._condition.notify_all()
@@ -0,0 +1,86 @@
+"""Time and bytes spent in each phase of reading and writing archives, and per-file progress callbacks"""
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Stats:
+    """
+    Collects the time and bytes of every phase readers, writers and their files report into
+    Usage example::
+        stats = Stats()
+        with XP3('data.xp3', 'r', stats=stats) as xp3:
+            xp3.extract('data')
+        print(stats.report())
+    Phases run on several threads at once with workers, their times add up the time of every thread,
+    so MB/s is the throughput of a single thread doing that phase
+    """
+    # Known phases in the order they are reported, others are reported after them
+    phases = ('index', 'read', 'checksum', 'decompress', 'decrypt', 'encrypt', 'compress', 'write')
+
+    def __init__(self):
+        self.seconds = {}
+        self.bytes = {}
+        self.calls = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, phase: str, seconds: float, size: int = 0):
+        """Record seconds spent in a phase on size bytes"""
+        with self._lock:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+            self.bytes[phase] = self.bytes.get(phase, 0) + size
+            self.calls[phase] = self.calls.get(phase, 0) + 1
+
+    @contextmanager
+    def measure(self, phase: str, size: int = 0):
+        """Record the time spent in the block as a phase on size bytes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start, size)
+
+    def throughput(self, phase: str) -> float:
+        """MB/s of a phase, 0 if nothing was measured"""
+        seconds = self.seconds.get(phase, 0.0)
+        return self.bytes.get(phase, 0) / seconds / 1e6 if seconds else 0.0
+
+    def report(self) -> str:
+        """Table of the time, bytes and MB/s of every phase measured, with the wall time since the stats were made"""
+        lines = ['{:>12} {:>10} {:>8} {:>12} {:>10}'.format('Phase', 'Calls', 'Seconds', 'MB', 'MB/s')]
+        known = [phase for phase in self.phases if phase in self.seconds]
+        for phase in known + sorted(set(self.seconds) - set(known)):
+            lines.append('{:>12} {:>10} {:>8.3f} {:>12.1f} {:>10.1f}'.format(
+                phase, self.calls[phase], self.seconds[phase], self.bytes[phase] / 1e6, self.throughput(phase)))
+        lines.append('{:>12} {:>10} {:>8.3f}'.format('wall', '', time.perf_counter() - self.started))
+        return '\n'.join(lines)
+
+
+class _NoStats(Stats):
+    """Stats that are not collected, the default so measuring costs next to nothing"""
+    _nothing = nullcontext()
+
+    def add(self, phase: str, seconds: float, size: int = 0):
+        pass
+
+    def measure(self, phase: str, size: int = 0):
+        return self._nothing
+
+
+no_stats = _NoStats()
+
+
+def print_progress(action: str, file_entry):
+    """
+    Default progress callback, prints a line per file
+    Progress callbacks are called as progress(action, file_entry) when a file starts being extracted
+    or has been packed, action is 'extract' or 'pack' and file_entry the XP3FileEntry of the file
+    """
+    if action == 'extract':
+        print('| Extracting {} ({} -> {} bytes)'.format(file_entry.file_path,
+                                                        file_entry.info.compressed_size,
+                                                        file_entry.info.uncompressed_size))
+    else:
+        print(f'| Packing {file_entry.file_path} ({file_entry.segm.uncompressed_size} -> '
+              f'{file_entry.segm.compressed_size} bytes)')
@@ -1,5 +1,5 @@
 from .constants import XP3Signature
-from .file import XP3File
+from .file import XP3File, XP3FileStream
 from .file_index import XP3FileIndex
 from .file_entry import XP3FileEntry, XP3IndexSpecialFormat, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo
 from .game_list import game_list
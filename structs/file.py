@@ -1,21 +1,39 @@
+import io
 import os
+import threading
+import time
 from io import BytesIO
+from contextlib import nullcontext
+from concurrent.futures import Executor
+from bisect import bisect_right
 import zlib
 from .file_entry import XP3FileEntry
 
 from encrypt.encrypt_interface import EncryptInterface
+from stats import Stats, no_stats
+
+# Bytes decompressed at once straight into the output of a file
+_DECOMPRESS_CHUNK = 256 * 1024
+
 
 class XP3DecryptionError(Exception):
     pass
 
 
+class XP3ChecksumError(Exception):
+    pass
+
+
 class XP3File(XP3FileEntry):
     """Wrapper around file entry with buffer access to be able to read the file"""
     buffer: BytesIO
     silent: bool
     use_numpy: bool
+    view: memoryview
+    stats: Stats
 
-    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy):
+    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy, view: memoryview = None,
+                 lock: threading.Lock = None, stats: Stats = None):
         super().__init__(
             special_format=index_entry.special_format,
             time=index_entry.time,
@@ -26,27 +44,151 @@ class XP3File(XP3FileEntry):
         self.buffer = buffer
         self.silent = silent
         self.use_numpy = use_numpy
+        self.view = view
+        self.lock = lock  # Held while seeking and reading the shared buffer
+        self.stats = stats or no_stats
 
-    def read(self, encryption_type='none', raw=False, encrypt_instance: EncryptInterface=None):
-        """Reads the file from buffer and return its data"""
-        for segment in self.segm:
-            self.buffer.seek(segment.offset)
-            data = self.buffer.read(segment.compressed_size)
+    def read_segment(self, segment):
+        """
+        Reads the stored bytes of a segment,
+        a memoryview slice of the archive if it is mapped, otherwise a bytearray read from the buffer
+        """
+        data = self.read_at(segment.offset, segment.compressed_size)
+        if len(data) != segment.compressed_size:
+            raise AssertionError('Segment at {} is truncated'.format(segment.offset))
+        return data
 
-            if segment.is_compressed:
-                data = zlib.decompress(data)
+    def read_at(self, offset: int, size: int):
+        """
+        Reads size bytes of the archive at offset,
+        into a bytearray that can be decrypted in place if the archive is not mapped
+        """
+        if self.view is not None:
+            return self.view[offset:offset + size]
+        with self.lock or nullcontext():
+            self.buffer.seek(offset)
+            if not hasattr(self.buffer, 'readinto'):
+                return self.buffer.read(size)
+            data = bytearray(size)
+            read = self.buffer.readinto(data)
+        if read < size:
+            del data[read:]
+        return data
+
+    def read_segments(self) -> list:
+        """Reads the stored bytes of every segment, without decompressing or decrypting them"""
+        with self.stats.measure('read', self.segm.compressed_size):
+            return [self.read_segment(segment) for segment in self.segm]
+
+    def read(self, encryption_type='none', raw=False, encrypt_instance: EncryptInterface=None,
+             executor: Executor = None):
+        """
+        Reads the file from buffer and return its data, without copying it more than needed,
+        so it is not always bytes: stored unencrypted files of a mapped archive are returned as a memoryview
+        of it, encrypted files, files split in segments and stored files of an unmapped archive as a bytearray
+        :param executor: Decode the segments of a file split in several of them on it
+        """
+        return self.decode(self.read_segments(), encryption_type, raw, encrypt_instance, executor)
+
+    def decode(self, segments: list, encryption_type='none', raw=False, encrypt_instance: EncryptInterface=None,
+               executor: Executor = None):
+        """
+        Decompresses and decrypts the stored segment bytes returned by read_segments,
+        does not touch the buffer so it can run on another thread than the reading
+        :param executor: Decode the segments of a file split in several of them on it,
+                         each one is written to its place in the output as soon as it is done
+        """
+        if self.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+        if len(segments) == 1:
+            segment, data = self.segm[0], segments[0]
+            if segment.is_compressed and self.is_encrypted:
+                # Decompressed into a bytearray, so it can be decrypted in place
+                output = bytearray(segment.uncompressed_size)
+                self._decompress_into(data, memoryview(output))
+                data = output
+            elif segment.is_compressed:
+                with self.stats.measure('decompress', segment.uncompressed_size):
+                    data = zlib.decompress(data)
             if len(data) != segment.uncompressed_size:
                 raise AssertionError(len(data), segment.uncompressed_size)
+            if self.is_encrypted:
+                if not isinstance(data, bytearray):
+                    data = bytearray(data)  # Slice of a mapped archive, which is read-only
+                with self.stats.measure('decrypt', len(data)):
+                    encrypt_instance.decrypt_buffer(data, self.adler32, 0, self.use_numpy)
+            return data
 
+        output = bytearray(self.segm.uncompressed_size)
+        view = memoryview(output)
+        jobs = []
+        position = 0
+        for segment, data in zip(self.segm, segments):
+            jobs.append((segment, data, view[position:position + segment.uncompressed_size], position))
+            position += segment.uncompressed_size
+
+        def decode_into(job):
+            segment, data, output, position = job
+            if segment.is_compressed:
+                self._decompress_into(data, output)
+            else:
+                if len(data) != segment.uncompressed_size:
+                    raise AssertionError(len(data), segment.uncompressed_size)
+                output[:] = data
             if self.is_encrypted:
-                file_buffer = BytesIO(data)
-                if encryption_type in ('none', None) and not raw:
-                    raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+                # Decrypted where it lands in the output
+                with self.stats.measure('decrypt', len(output)):
+                    encrypt_instance.decrypt_buffer(output, self.adler32, position, self.use_numpy)
 
-                encrypt_instance.decrypt(file_buffer, self.adler32, self.use_numpy)
-                data = file_buffer.getvalue()
-                file_buffer.close()
-        return data
+        list(executor.map(decode_into, jobs) if executor is not None else map(decode_into, jobs))
+        return output
+
+    def _decompress_into(self, data, output: memoryview):
+        """Decompresses data straight into output, a chunk at a time, it has to fill output exactly"""
+        with self.stats.measure('decompress', len(output)):
+            decompressor = zlib.decompressobj()
+            position = 0
+            while True:
+                chunk = decompressor.decompress(data, _DECOMPRESS_CHUNK)
+                data = decompressor.unconsumed_tail
+                if not chunk:
+                    break
+                if position + len(chunk) > len(output):
+                    raise AssertionError(position + len(chunk), len(output))
+                output[position:position + len(chunk)] = chunk
+                position += len(chunk)
+        if not decompressor.eof:
+            raise zlib.error('Error -5 while decompressing data: incomplete or truncated stream')
+        if position != len(output):
+            raise AssertionError(position, len(output))
+
+    def open_stream(self, encryption_type='none', raw=False, encrypt_instance: EncryptInterface = None,
+                    verify=False, chunk_size: int = 64 * 1024):
+        """
+        Opens the file as a readable stream that decompresses and decrypts segments incrementally
+        :param verify: Raise XP3ChecksumError at the end of the file if its adler32 does not match
+        :param chunk_size: Number of stored bytes read from the archive at once
+        """
+        if self.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+        return XP3FileStream(self, encrypt_instance if self.is_encrypted else None, verify, chunk_size)
+
+    def read_range(self, offset: int, length: int, encryption_type='none', raw=False,
+                   encrypt_instance: EncryptInterface = None) -> bytes:
+        """
+        Reads length bytes of the file starting at offset,
+        only the segments overlapping the range are read and only the returned bytes are decrypted
+        """
+        with self.open_stream(encryption_type, raw, encrypt_instance) as stream:
+            stream.seek(offset)
+            chunks = []
+            while length > 0:
+                chunk = stream.read(length)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                length -= len(chunk)
+        return b''.join(chunks)
 
     def extract(self, to='', name=None, encryption_type='none', raw=False, encrypt_instance: EncryptInterface=None):
         """
@@ -54,9 +196,17 @@ class XP3File(XP3FileEntry):
         if no location is specified, unpacks into folder with archive name (data.xp3, unpacks into data folder)
         """
         file = self.read(encryption_type=encryption_type, raw=raw, encrypt_instance=encrypt_instance)
-        if zlib.adler32(file) != self.adler32 and not self.silent:
+        if not self.verify(file) and not self.silent:
             print('! Checksum error')
+        self.save(file, to, name)
 
+    def verify(self, data) -> bool:
+        """Tells if decoded data of the file matches its adler32"""
+        with self.stats.measure('checksum', len(data)):
+            return zlib.adler32(data) == self.adler32
+
+    def save(self, file, to='', name=None):
+        """Saves already read data of the file to specified folder, see extract"""
         if not to:
             # Use archive name as output folder if it's not explicitly specified
             basename = os.path.basename(self.buffer.name)
@@ -68,7 +218,156 @@ class XP3File(XP3FileEntry):
         if not os.path.exists(dirname):
             os.makedirs(dirname)
 
-        with open(to, 'wb') as output:
+        with self.stats.measure('write', len(file)), open(to, 'wb') as output:
             output.write(file)
 
 
+class XP3FileStream(io.RawIOBase):
+    """Readable and seekable stream over a file in the archive, decodes only as much as is read"""
+    file: XP3File
+
+    def __init__(self, file: XP3File, encrypt_instance=None, verify=False, chunk_size: int = 64 * 1024):
+        """
+        :param file: File to read
+        :param encrypt_instance: Decrypt the file with it, if any
+        :param verify: Check the adler32 of the file once the end of it is reached (if it was read from the start)
+        :param chunk_size: Number of stored bytes read from the archive at once
+        """
+        super().__init__()
+        self.file = file
+        self.encrypt_instance = encrypt_instance
+        self.verify = verify
+        self.chunk_size = chunk_size
+        self._segments = list(file.segm)
+        self._starts = [0]  # Position of every segment in the decoded file
+        for segment in self._segments:
+            self._starts.append(self._starts[-1] + segment.uncompressed_size)
+        self._verifying = verify
+        self._position = 0  # Position in the decoded file
+        self._adler32 = 1
+        self._segment = 0  # Current segment
+        self._segment_read = 0  # Stored bytes of the current segment read from the archive
+        self._segment_decoded = 0  # Bytes of the current segment returned
+        self._decompressor = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """
+        Moves to a position in the decoded file, only the segment holding it is touched:
+        stored segments are read from there, compressed ones are decompressed from their start
+        (or from the current position when moving forward in the same segment)
+        """
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._starts[-1]
+        elif whence != io.SEEK_SET:
+            raise ValueError('Invalid whence {}'.format(whence))
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+
+        if offset == self._position:
+            return offset
+        # The checksum covers the whole file, so it can only be verified when reading from the start
+        self._verifying = self.verify and offset == 0
+        self._adler32 = 1
+        self._position = offset
+        if offset >= self._starts[-1]:
+            self._segment = len(self._segments)
+            return offset
+
+        index = bisect_right(self._starts, offset) - 1
+        segment = self._segments[index]
+        skip = offset - self._starts[index]
+        if not segment.is_compressed:
+            self._segment, self._segment_read, self._segment_decoded = index, skip, skip
+            self._decompressor = None
+            return offset
+
+        if index != self._segment or self._segment_decoded > skip:
+            self._segment, self._segment_read, self._segment_decoded = index, 0, 0
+            self._decompressor = None
+        skip -= self._segment_decoded
+        while skip:
+            skip -= len(self._next(min(skip, self.chunk_size)))
+        return offset
+
+    def readinto(self, b) -> int:
+        with memoryview(b) as view, view.cast('B') as view:
+            size = len(view)
+            if not size:
+                return 0
+            data = b''
+            while not data:
+                if self._segment >= len(self._segments):
+                    self._finish()
+                    return 0
+                data = self._next(size)
+
+            size = len(data)
+            view[:size] = data
+            stats = self.file.stats
+            if self.encrypt_instance is not None:
+                with stats.measure('decrypt', size):
+                    self.encrypt_instance.decrypt_buffer(view[:size], self.file.adler32, self._position,
+                                                         self.file.use_numpy)
+            if self._verifying:
+                with stats.measure('checksum', size):
+                    self._adler32 = zlib.adler32(view[:size], self._adler32)
+
+            self._position += size
+            return size
+
+    def _next(self, size: int):
+        """Decode up to size bytes of the current segment"""
+        segment = self._segments[self._segment]
+        remaining = segment.compressed_size - self._segment_read
+
+        stats = self.file.stats
+        if not segment.is_compressed:
+            with stats.measure('read', min(size, remaining)):
+                data = self.file.read_at(segment.offset + self._segment_read, min(size, remaining))
+            if len(data) != min(size, remaining):
+                raise AssertionError('Segment at {} is truncated'.format(segment.offset))
+            self._segment_read += len(data)
+        else:
+            if self._decompressor is None:
+                self._decompressor = zlib.decompressobj()
+            stored = self._decompressor.unconsumed_tail
+            if not stored and remaining:
+                with stats.measure('read', min(self.chunk_size, remaining)):
+                    stored = self.file.read_at(segment.offset + self._segment_read,
+                                               min(self.chunk_size, remaining))
+                if not stored:
+                    raise AssertionError('Segment at {} is truncated'.format(segment.offset))
+                self._segment_read += len(stored)
+            start = time.perf_counter()
+            data = self._decompressor.decompress(stored, size)
+            stats.add('decompress', time.perf_counter() - start, len(data))
+            if not data and not self._decompressor.eof and self._segment_read >= segment.compressed_size \
+                    and not self._decompressor.unconsumed_tail:
+                raise AssertionError('Compressed segment at {} ended early'.format(segment.offset))
+
+        self._segment_decoded += len(data)
+        if self._segment_decoded > segment.uncompressed_size:
+            raise AssertionError(self._segment_decoded, segment.uncompressed_size)
+        finished = self._decompressor.eof if segment.is_compressed else self._segment_read >= segment.compressed_size
+        if finished:
+            if self._segment_decoded != segment.uncompressed_size:
+                raise AssertionError(self._segment_decoded, segment.uncompressed_size)
+            self._segment += 1
+            self._segment_read = self._segment_decoded = 0
+            self._decompressor = None
+        return data
+
+    def _finish(self):
+        if self._verifying and self._adler32 != self.file.adler32:
+            raise XP3ChecksumError('Checksum error in {}'.format(self.file.file_path))
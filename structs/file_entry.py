@@ -46,19 +46,23 @@ class XP3IndexSpecialFormat:
 class XP3FileTime:
     time_chunk = struct.Struct('<QQ')
 
-    def __init__(self, timestamp: int = 0):
+    def __init__(self, timestamp: int = 0, raw: int = None):
+        """
+        :param timestamp: Timestamp to expose (milliseconds when packing, seconds when read from an index)
+        :param raw: Value stored in the time chunk, same as timestamp if not specified
+        """
         self.timestamp = timestamp
-
+        self.raw = timestamp if raw is None else raw
 
     @classmethod
     def read_from(cls, buffer: BufferedReader):
         size, timestamp = cls.time_chunk.unpack(buffer.read(16))
         if size != 8:
             raise AssertionError
-        return cls(timestamp // 1000)
+        return cls(timestamp // 1000, timestamp)
 
     def to_bytes(self):
-        return b'time' + self.time_chunk.pack(8, self.timestamp)
+        return b'time' + self.time_chunk.pack(8, self.raw)
 
 
 class XP3FileSegments:
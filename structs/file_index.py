@@ -1,9 +1,12 @@
 import os
 import zlib
+import codecs
 import struct
-from .file_entry import XP3FileEntry
-from io import BytesIO
-from .constants import XP3Signature, XP3FileIndexContinue, XP3FileIndexCompressed, Xp3FileIndexUncompressed
+from array import array
+from .file_entry import XP3FileEntry, XP3IndexSpecialFormat, XP3FileTime, XP3FileAdler, XP3FileSegments, \
+    XP3FileInfo
+from .constants import XP3Signature, XP3FileIndexContinue, XP3FileIndexCompressed, Xp3FileIndexUncompressed, \
+    XP3FileIsEncrypted
 
 
 class peek:
@@ -30,25 +33,204 @@ class peek:
 
 
 class XP3FileIndex:
-    def __init__(self, entries: list, buffer=None):
-        self.entries = entries
-        self.path_index = {entry.file_path: index for index, entry in enumerate(entries)}
+    _chunk_header = struct.Struct('<4sQ')
+    _special_chunk = struct.Struct('<QIH')
+    _info_chunk = struct.Struct('<IQQH')
+    # 'File' chunk holding time, adlr, a single segm and info chunks in this order, up to the info file path
+    _common_entry = struct.Struct('<4sQ' '4sQQ' '4sQI' '4sQ?3xQQQ' '4sQIQQH')
+    _u32 = struct.Struct('<I')
+    _u64 = struct.Struct('<Q')
+
+    def __init__(self, entries: list = (), buffer=None):
+        """
+        Entries are kept in parallel columns, XP3FileEntry objects are only built when accessed
+        :param entries: XP3FileEntry objects to fill the index with
+        :param buffer: Archive buffer the index was read from
+        """
         self.buffer = buffer
+        self._path_index = None
+
+        # Entry columns
+        self._timestamps = array('Q')  # Raw value of the time chunk
+        self._adler32 = array('I')
+        self._flags = array('I')
+        self._uncompressed_sizes = array('Q')
+        self._compressed_sizes = array('Q')
+        self._file_paths = []
+        self._special_formats = {}  # Entry position -> (special_field, file_path), only for entries having one
+        # Segment columns, segments of entry i are in range(_segment_starts[i], _segment_starts[i + 1])
+        self._segment_starts = array('Q', [0])
+        self._segment_compressed = array('B')
+        self._segment_offsets = array('Q')
+        self._segment_uncompressed_sizes = array('Q')
+        self._segment_compressed_sizes = array('Q')
+
+        for entry in entries:
+            self.append(entry)
 
     @classmethod
     def from_entries(cls, entries: list, buffer=None):
         return cls(entries, buffer)
 
+    @classmethod
+    def from_index(cls, index, buffer=None):
+        """Constructor to instantiate class from a decompressed file index"""
+        file_index = cls(buffer=buffer)
+        for fields in cls.scan(index):
+            file_index._append_fields(*fields)
+        return file_index
+
     @classmethod
     def read_from(cls, buffer):
         """Constructor to instantiate class from buffer"""
-        index = cls.read_index(buffer)
-        entries = []
-        with BytesIO(index) as index_buffer:
-            while index_buffer.tell() < len(index):
-                entries.append(XP3FileEntry.read_from(index_buffer))
+        return cls.from_index(cls.read_index(buffer), buffer)
+
+    @classmethod
+    def parse(cls, index) -> list:
+        """
+        Parses the decompressed file index (bytes or memoryview) into file entries in a single pass,
+        reading every field in place with unpack_from instead of going through a buffer chunk by chunk
+        """
+        return [cls._make_entry(*fields) for fields in cls.scan(index)]
+
+    def append(self, entry: XP3FileEntry):
+        """Add a file entry to the end of the index"""
+        special_format = entry.special_format
+        self._append_fields(special_format.special_field if special_format else b'',
+                            special_format.file_path if special_format else None,
+                            entry.time.raw,
+                            entry.adler32,
+                            entry.segm.segments,
+                            XP3FileIsEncrypted if entry.info.is_encrypted else 0,
+                            entry.info.uncompressed_size,
+                            entry.info.compressed_size,
+                            entry.info.file_path)
+
+    def _append_fields(self, special_field, special_path, timestamp, adler32, segments, flags, uncompressed_size,
+                       compressed_size, file_path):
+        position = len(self._file_paths)
+        self._timestamps.append(timestamp)
+        self._adler32.append(adler32)
+        self._flags.append(flags)
+        self._uncompressed_sizes.append(uncompressed_size)
+        self._compressed_sizes.append(compressed_size)
+        self._file_paths.append(file_path)
+        if special_field:
+            self._special_formats[position] = (special_field, special_path)
+        for is_compressed, offset, segment_uncompressed_size, segment_compressed_size in segments:
+            self._segment_compressed.append(is_compressed)
+            self._segment_offsets.append(offset)
+            self._segment_uncompressed_sizes.append(segment_uncompressed_size)
+            self._segment_compressed_sizes.append(segment_compressed_size)
+        self._segment_starts.append(len(self._segment_offsets))
+        if self._path_index is not None:
+            self._path_index[self.file_path(position)] = position
+
+    @classmethod
+    def scan(cls, index):
+        """
+        Walks the decompressed file index and yields the raw fields of every entry as
+        (special_field, special_path, timestamp, adler32, segments, flags, uncompressed_size, compressed_size,
+        file_path), special_field is empty when the entry has no maker specific chunk
+        """
+        chunk_header = cls._chunk_header.unpack_from
+        special_chunk = cls._special_chunk.unpack_from
+        common_entry = cls._common_entry.unpack_from
+        info_chunk = cls._info_chunk.unpack_from
+        u32 = cls._u32.unpack_from
+        u64 = cls._u64.unpack_from
+        segment_chunk = XP3FileSegments._segment.iter_unpack
+        decode = codecs.utf_16_le_decode
+        common_entry_size = cls._common_entry.size
+
+        position = 0
+        end = len(index)
+        while position < end:
+            if position + 12 > end:
+                raise AssertionError('File index is truncated at {}'.format(position))
+            name, size = chunk_header(index, position)
+            special_field = b''
+            special_path = special_adler32 = None
+            if name != b'File':  # Maker specific chunk in front of the 'File' chunk
+                if position + 18 > end:
+                    raise AssertionError('File index is truncated at {}'.format(position))
+                _, special_adler32, file_path_length = special_chunk(index, position + 4)
+                path_start = position + 18
+                path_end = path_start + file_path_length * 2
+                if path_end + 2 != position + 12 + size:
+                    raise AssertionError('Index position {}, expected {}'.format(path_end + 2, position + 12 + size))
+                if path_end + 2 > end:
+                    raise AssertionError('File index is truncated at {}'.format(position))
+                special_field = bytes(name)
+                special_path = decode(index[path_start:path_end])[0]
+                position = path_end + 2
+                if index[position:position + 4] != b'File':
+                    raise AssertionError("Expected 'File' chunk after maker specific chunk in index file entry")
+                if position + 12 > end:
+                    raise AssertionError('File index is truncated at {}'.format(position))
+
+            # Almost every entry is laid out as time, adlr, one segment and info, read it with a single unpack
+            if position + common_entry_size <= end:
+                (_, size, time_name, time_size, timestamp, adlr_name, adlr_size, adler32,
+                 segm_name, segm_size, is_compressed, offset, uncompressed_size, compressed_size,
+                 info_name, info_size, flags, info_uncompressed_size, info_compressed_size, file_path_length) \
+                    = common_entry(index, position)
+                path_start = position + common_entry_size
+                path_end = path_start + file_path_length * 2
+                if time_name == b'time' and adlr_name == b'adlr' and segm_name == b'segm' and info_name == b'info' \
+                        and time_size == 8 and adlr_size == 4 and segm_size == 28 \
+                        and size == 88 + info_size and info_size == 24 + file_path_length * 2:
+                    if path_end + 2 > end:
+                        raise AssertionError('File index is truncated at {}'.format(position))
+                    if special_adler32 is not None and special_adler32 != adler32:
+                        raise AssertionError('Checksum values in adlr chunk and special_format chunk do not match')
+                    yield (special_field, special_path, timestamp, adler32,
+                           ((is_compressed, offset, uncompressed_size, compressed_size),),
+                           flags, info_uncompressed_size, info_compressed_size,
+                           decode(index[path_start:path_end])[0])
+                    position = path_end + 2
+                    continue
+
+            _, size = chunk_header(index, position)
+            chunk = position + 12
+            entry_end = chunk + size
+            if entry_end > end:
+                raise AssertionError('File index is truncated at {}'.format(position))
+            timestamp = 0  # time chunk is not always present
+            adler32 = segments = file_path = None
+            while chunk < entry_end:
+                if chunk + 12 > entry_end:
+                    raise AssertionError('Index position {}, expected {}'.format(chunk + 12, entry_end))
+                name, size = chunk_header(index, chunk)
+                body = chunk + 12
+                if body + size > entry_end:
+                    raise AssertionError('Index position {}, expected {}'.format(body + size, entry_end))
+                if name == b'time':
+                    if size != 8:
+                        raise AssertionError
+                    timestamp, = u64(index, body)
+                elif name == b'adlr':
+                    if size != 4:  # adler value size should always be 4 bytes
+                        raise AssertionError
+                    adler32, = u32(index, body)
+                elif name == b'segm':
+                    segments = tuple(segment_chunk(index[body:body + size - size % 28]))
+                elif name == b'info':
+                    flags, info_uncompressed_size, info_compressed_size, file_path_length = info_chunk(index, body)
+                    path_start = body + 22
+                    path_end = path_start + file_path_length * 2
+                    if path_end + 2 != body + size:
+                        raise AssertionError('Index position {}, expected {}'.format(path_end + 2, body + size))
+                    file_path = decode(index[path_start:path_end])[0]
+                chunk = body + size
 
-        return cls.from_entries(entries, buffer)
+            if adler32 is None or not segments or file_path is None:
+                raise AssertionError
+            if special_adler32 is not None and special_adler32 != adler32:
+                raise AssertionError('Checksum values in adlr chunk and special_format chunk do not match')
+            yield (special_field, special_path, timestamp, adler32, segments,
+                   flags, info_uncompressed_size, info_compressed_size, file_path)
+            position = entry_end
 
     def extract(self, to=''):
         """Dump file index from buffer"""
@@ -94,7 +276,7 @@ class XP3FileIndex:
         return index
 
     def to_bytes(self, compress=False):
-        uncompressed_index = b''.join([entry.to_bytes() for entry in self.entries])
+        uncompressed_index = b''.join([self.entry_to_bytes(position) for position in range(len(self))])
         uncompressed_size = len(uncompressed_index)
         if not compress:
             return struct.pack('<BQ', Xp3FileIndexUncompressed, uncompressed_size) + uncompressed_index
@@ -108,17 +290,110 @@ class XP3FileIndex:
             else:
                 return struct.pack('<BQ', Xp3FileIndexUncompressed, uncompressed_size) + uncompressed_index
 
+    def entry_to_bytes(self, position: int) -> bytes:
+        """Serialise a single entry straight from the columns"""
+        segment_start, segment_end = self._segment_starts[position], self._segment_starts[position + 1]
+        if segment_end - segment_start != 1:
+            return self[position].to_bytes()
+
+        file_path = self._file_paths[position]
+        info_size = 24 + len(file_path) * 2
+        entry = self._common_entry.pack(
+            b'File', 88 + info_size,
+            b'time', 8, self._timestamps[position],
+            b'adlr', 4, self._adler32[position],
+            b'segm', 28, self._segment_compressed[segment_start], self._segment_offsets[segment_start],
+            self._segment_uncompressed_sizes[segment_start], self._segment_compressed_sizes[segment_start],
+            b'info', info_size, self._flags[position], self._uncompressed_sizes[position],
+            self._compressed_sizes[position], len(file_path)
+        ) + file_path.encode('utf-16le') + b'\x00\x00'
+
+        special_format = self._special_formats.get(position)
+        if special_format:
+            special_field, special_path = special_format
+            entry = XP3IndexSpecialFormat(self._adler32[position], special_path, special_field).to_bytes() + entry
+        return entry
+
+    @property
+    def entries(self) -> list:
+        """All file entries, builds an XP3FileEntry for every one of them"""
+        return list(self)
+
+    @property
+    def path_index(self) -> dict:
+        """File path to entry position mapping, built on first lookup by path"""
+        if self._path_index is None:
+            self._path_index = {self.file_path(position): position for position in range(len(self))}
+        return self._path_index
+
+    @property
+    def is_encrypted(self) -> bool:
+        return any(flags & XP3FileIsEncrypted for flags in self._flags)
+
+    def file_path(self, position: int) -> str:
+        """Internal file path of an entry, without building the entry"""
+        special_format = self._special_formats.get(position)
+        if special_format and self._flags[position] & XP3FileIsEncrypted:
+            return special_format[1]
+        return self._file_paths[position]
+
+    def copy(self, exclude=()) -> 'XP3FileIndex':
+        """New index holding the entries of this one but the positions in exclude, straight from the columns"""
+        file_index = type(self)(buffer=self.buffer)
+        for position in range(len(self)):
+            if position not in exclude:
+                file_index._append_fields(*self._fields(position))
+        return file_index
+
+    def _fields(self, position: int) -> tuple:
+        """Raw fields of the entry at position, as yielded by scan"""
+        segments = [(self._segment_compressed[i], self._segment_offsets[i],
+                     self._segment_uncompressed_sizes[i], self._segment_compressed_sizes[i])
+                    for i in range(self._segment_starts[position], self._segment_starts[position + 1])]
+        special_field, special_path = self._special_formats.get(position, (b'', None))
+        return (special_field, special_path, self._timestamps[position], self._adler32[position], segments,
+                self._flags[position], self._uncompressed_sizes[position], self._compressed_sizes[position],
+                self._file_paths[position])
+
+    def _entry(self, position: int) -> XP3FileEntry:
+        """Build the file entry at position from the columns"""
+        return self._make_entry(*self._fields(position))
+
+    @staticmethod
+    def _make_entry(special_field, special_path, timestamp, adler32, segments, flags, uncompressed_size,
+                    compressed_size, file_path) -> XP3FileEntry:
+        """Build a file entry from the fields yielded by scan"""
+        segment = XP3FileSegments.segment
+        return XP3FileEntry(time=XP3FileTime(timestamp // 1000, timestamp),
+                            adlr=XP3FileAdler(adler32),
+                            segm=XP3FileSegments([segment(bool(is_compressed), offset, segment_uncompressed_size,
+                                                          segment_compressed_size)
+                                                  for is_compressed, offset, segment_uncompressed_size,
+                                                  segment_compressed_size in segments]),
+                            info=XP3FileInfo(bool(flags & XP3FileIsEncrypted), uncompressed_size, compressed_size,
+                                             file_path),
+                            special_format=XP3IndexSpecialFormat(adler32, special_path, special_field)
+                            if special_field else None)
+
+    def __len__(self):
+        return len(self._file_paths)
+
     def __iter__(self):
-        yield from self.entries
+        for position in range(len(self)):
+            yield self._entry(position)
 
     def __getitem__(self, item):
         """Access file entries by index position or their file path"""
         if isinstance(item, int):
-            return self.entries[item]
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError('File index position out of range')
+            return self._entry(item)
         elif isinstance(item, str):
-            return self.entries[self.path_index[item]]
+            return self._entry(self.path_index[item])
         else:
             raise TypeError
 
     def __repr__(self):
-        return "<XP3FileIndex, {} entry(ies)>".format(len(self.entries))
+        return "<XP3FileIndex, {} entry(ies)>".format(len(self))
@@ -1,10 +1,31 @@
+import io
 import os
+import random
+import zlib
+import struct
 import unittest
+from io import BytesIO
 import datetime
 import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from xp3 import XP3, XP3Reader, XP3Writer
+from pipeline import ByteBudget
+from batch import process_xp3
+from cache import DiskCache
+from stats import Stats
+from compression import CompressionPolicy, BlockCompressor, adler32_combine
+from structs import XP3FileIndex, XP3FileEntry, XP3IndexSpecialFormat, XP3FileTime, XP3FileAdler, \
+    XP3FileSegments, XP3FileInfo, XP3Signature
+from structs.file import XP3ChecksumError, XP3DecryptionError
 from structs.game_list import game_list
 from encrypt.encrypt_interface import EncryptInterface
+from encrypt.xor import xor_byte
+
+try:
+    import numpy
+except ModuleNotFoundError:
+    numpy = None
 
 class Encryption(unittest.TestCase):
     """Encryption test with Numpy and pure Python XORing"""
@@ -22,9 +43,6 @@ class Encryption(unittest.TestCase):
             self.assertEqual(data, file.read(encryption_type=game_name, encrypt_instance=encrypt_instance))
 
     def with_numpy(self, data):
-        # Crash test early if Numpy is not present
-        import numpy
-        del numpy
         for game_name in game_list:
             crypt_class, params, _,  = game_list[game_name]
             encrypt_instance = crypt_class(**params)
@@ -38,9 +56,11 @@ class Encryption(unittest.TestCase):
             print(f'Testing {game_name} without numpy')
             self.encrypt_and_decrypt(data, game_name, False, encrypt_instance)
 
+    @unittest.skipUnless(numpy, 'numpy is not installed')
     def test_numpy_uncompressed(self):
         self.with_numpy(b'dummy_data')
 
+    @unittest.skipUnless(numpy, 'numpy is not installed')
     def test_numpy_compressed(self):
         self.with_numpy(b'111111111111')
 
@@ -50,6 +70,128 @@ class Encryption(unittest.TestCase):
     def test_python_compressed(self):
         self.with_python(b'111111111111')
 
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_buffer(self):
+        """In place encryption of any writable buffer matches the BytesIO interface, which adapts to it"""
+        data = os.urandom(100)
+        for game_name in game_list:
+            crypt_class, params, _, = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for use_numpy in (True, False):
+                with BytesIO(data) as buffer:
+                    encrypt_instance.encrypt(buffer, 0x12345678, use_numpy, 7)
+                    expected = buffer.getvalue()
+                for buffer in (bytearray(data), memoryview(bytearray(data)), numpy.frombuffer(bytearray(data), 'u1')):
+                    encrypt_instance.encrypt_buffer(buffer, 0x12345678, 7, use_numpy)
+                    self.assertEqual(expected, bytes(buffer))
+                    encrypt_instance.decrypt_buffer(buffer, 0x12345678, 7, use_numpy)
+                    self.assertEqual(data, bytes(buffer))
+
+    @unittest.skipUnless(numpy, 'numpy is not installed')
+    def test_python_matches_numpy(self):
+        """The pure Python XOR gives the same result as numpy, across the chunks it works in"""
+        for size in (0, 1, 31, 33, 1024 * 1024 + 5):
+            data = os.urandom(size)
+            for game_name in game_list:
+                crypt_class, params, _, = game_list[game_name]
+                encrypt_instance = crypt_class(**params)
+                with_numpy, without_numpy = bytearray(data), bytearray(data)
+                encrypt_instance.encrypt_buffer(with_numpy, 0x9ABCDEF0, 5, True)
+                encrypt_instance.encrypt_buffer(without_numpy, 0x9ABCDEF0, 5, False)
+                self.assertEqual(with_numpy, without_numpy)
+
+    def test_many(self):
+        """Batch crypt of many buffers gives the same result as one call per buffer"""
+        sizes = (0, 1, 31, 100, 300, 3000) * 5
+        for game_name in game_list:
+            crypt_class, params, _, = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for use_numpy in (True, False):
+                items = [(bytearray(os.urandom(size)), size * 2654435761 & 0xFFFFFFFF, size // 3) for size in sizes]
+                expected = [bytearray(buffer) for buffer, _, _ in items]
+                for buffer, (_, adler32, offset) in zip(expected, items):
+                    encrypt_instance.encrypt_buffer(buffer, adler32, offset, use_numpy)
+                originals = [bytes(buffer) for buffer, _, _ in items]
+                encrypt_instance.encrypt_many(items, use_numpy)
+                self.assertEqual(expected, [buffer for buffer, _, _ in items])
+                encrypt_instance.decrypt_many([(buffer, adler32) if not offset else (buffer, adler32, offset)
+                                               for buffer, adler32, offset in items], use_numpy)
+                self.assertEqual(originals, [bytes(buffer) for buffer, _, _ in items])
+
+    def test_chunked(self):
+        """Any chunking of a file gives the same result as applying the crypt to the whole file at once"""
+        rng = random.Random(1234)
+        for game_name in game_list:
+            crypt_class, params, _, = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for use_numpy in (True, False):
+                for _ in range(20):
+                    data = rng.randbytes(rng.choice((1, 33, 100, 1000)))
+                    adler32 = rng.getrandbits(32)
+                    whole = bytearray(data)
+                    encrypt_instance.apply(whole, adler32, 0, use_numpy)
+                    cuts = sorted(rng.sample(range(len(data) + 1), min(len(data) + 1, rng.randint(0, 6))))
+                    chunked = bytearray(data)
+                    with memoryview(chunked) as view:
+                        for start, end in zip([0] + cuts, cuts + [len(data)]):
+                            encrypt_instance.apply(view[start:end], adler32, start, use_numpy)
+                    self.assertEqual(whole, chunked, (game_name, cuts))
+                    encrypt_instance.apply(whole, adler32, 0, use_numpy)
+                    self.assertEqual(data, whole)
+
+    def test_read_in_place(self):
+        """Encrypted files are decrypted in the buffer they are read or decompressed into"""
+        crypt_class, params, _ = game_list['neko_vol0']
+        encrypt_instance = crypt_class(**params)
+        files = (('stored', os.urandom(1000)), ('compressed', b'1' * 600000))
+        with XP3Writer(silent=True, game_name='neko_vol0', encrypt_instance=encrypt_instance, compressed=True) as xp3:
+            for filepath, data in files:
+                xp3.add(filepath, data)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            for filepath, data in files:
+                read = xp3.open(filepath).read('neko_vol0', encrypt_instance=encrypt_instance)
+                self.assertIsInstance(read, bytearray)
+                self.assertEqual(data, read)
+            file = xp3.open('compressed')
+            self.assertTrue(file.segm[0].is_compressed)
+            truncated = bytes(file.read_segments()[0])[:-10]
+            with self.assertRaises(zlib.error):
+                file.decode([truncated], 'neko_vol0', encrypt_instance=encrypt_instance)
+
+    def test_legacy(self):
+        """A scheme written against the original BytesIO interface works through the in place one"""
+        class Legacy(EncryptInterface):
+            def encrypt(self, buffer, adler32, use_numpy=False):
+                data = buffer.getvalue()
+                buffer.seek(0)
+                buffer.write(bytes(byte ^ adler32 & 0xFF for byte in data))
+
+            decrypt = encrypt
+
+        class Chunked(EncryptInterface):
+            def encrypt(self, buffer, adler32, use_numpy=False, offset=0):
+                data = buffer.getvalue()
+                buffer.seek(0)
+                buffer.write(bytes(byte ^ (offset + i) % 256 for i, byte in enumerate(data)))
+
+        data = bytearray(b'legacy')
+        Legacy().encrypt_buffer(data, 7)
+        self.assertEqual(bytes(byte ^ 7 for byte in b'legacy'), data)
+        with self.assertRaises(NotImplementedError):  # Can not start in the middle of the file
+            Legacy().encrypt_buffer(data, 7, 3)
+        data = bytearray(b'legacy')
+        Chunked().encrypt_buffer(data, 1, 3)
+        self.assertEqual(bytes(byte ^ (3 + i) for i, byte in enumerate(b'legacy')), data)
+
+        # Whole files are packed and read through it
+        with XP3Writer(silent=True, game_name='neko_vol0', encrypt_instance=Legacy()) as xp3:
+            xp3.add('scenario.ks', b'script ' * 100)
+            archive = xp3.pack_up()
+        with XP3Reader(archive, silent=True) as xp3:
+            self.assertEqual(b'script ' * 100, xp3.open('scenario.ks').read('neko_vol0', encrypt_instance=Legacy()))
+
 
 class FolderReadAndWrite(unittest.TestCase):
     """Read and write from and into file"""
@@ -112,6 +254,711 @@ class MemoryReadAndWrite(unittest.TestCase):
                 self.assertEqual(compressed, file.segm.segments[0].is_compressed)
 
 
+class MappedRead(unittest.TestCase):
+    """Read through a memory-mapped archive"""
+
+    dummy_data = (
+        ('stored_file', b'dummydata1'),
+        ('compressed_file', b'1' * 1024),
+    )
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with open(xp3_path, 'wb') as buffer, XP3Writer(buffer, silent=True, compressed=True) as xp3:
+                for filepath, data in self.dummy_data:
+                    xp3.add(filepath, data)
+
+            with XP3(xp3_path, mode='r', silent=True, use_mmap=True) as xp3:
+                stored = xp3.open('stored_file')
+                compressed = xp3.open('compressed_file')
+                self.assertFalse(stored.segm[0].is_compressed)
+                self.assertTrue(compressed.segm[0].is_compressed)
+                self.assertIsInstance(stored.read(), memoryview)
+                for filepath, data in self.dummy_data:
+                    self.assertEqual(data, bytes(xp3.open(filepath).read()))
+                xp3.extract(os.path.join(xp3dir, 'out'))
+
+            for filepath, data in self.dummy_data:
+                with open(os.path.join(xp3dir, 'out', filepath), 'rb') as file:
+                    self.assertEqual(data, file.read())
+
+    def test_close_writer(self):
+        """Archives opened without mapping, writers included, close too"""
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3 = XP3(os.path.join(xp3dir, 'data.xp3'), mode='w', silent=True)
+            xp3.close()
+            self.assertTrue(xp3.buffer.closed)
+
+
+class IndexParse(unittest.TestCase):
+    """Single-pass index parser has to produce the same entries as the chunk by chunk one"""
+
+    @staticmethod
+    def make_index():
+        segment = XP3FileSegments.segment
+        plain = XP3FileEntry(time=XP3FileTime(5000), adlr=XP3FileAdler(1),
+                             segm=XP3FileSegments([segment(True, 16, 10, 5)]),
+                             info=XP3FileInfo(False, 10, 5, 'plain'))
+        special = XP3FileEntry(time=XP3FileTime(6000), adlr=XP3FileAdler(2),
+                               segm=XP3FileSegments([segment(False, 21, 4, 4)]),
+                               info=XP3FileInfo(True, 4, 4, '0123456789abcdef'),
+                               special_format=XP3IndexSpecialFormat(2, 'special', b'neko'))
+        multiple = XP3FileEntry(time=XP3FileTime(7000), adlr=XP3FileAdler(3),
+                                segm=XP3FileSegments([segment(True, 25, 10, 3), segment(False, 28, 6, 6)]),
+                                info=XP3FileInfo(False, 16, 9, 'multiple'))
+        # An entry without the optional time chunk
+        untimed = XP3FileAdler(4).to_bytes() \
+            + XP3FileSegments([segment(False, 34, 2, 2)]).to_bytes() \
+            + XP3FileInfo(False, 2, 2, 'untimed').to_bytes()
+        untimed = struct.pack('<4sQ', b'File', len(untimed)) + untimed
+        return plain.to_bytes() + special.to_bytes() + multiple.to_bytes() + untimed
+
+    def test(self):
+        index = self.make_index()
+        expected = []
+        with BytesIO(index) as index_buffer:
+            while index_buffer.tell() < len(index):
+                expected.append(XP3FileEntry.read_from(index_buffer))
+
+        for data in (index, memoryview(index)):
+            entries = XP3FileIndex.parse(data)
+            self.assertEqual(len(expected), len(entries))
+            for expected_entry, entry in zip(expected, entries):
+                self.assertEqual(expected_entry.file_path, entry.file_path)
+                self.assertEqual(expected_entry.time.timestamp, entry.time.timestamp)
+                self.assertEqual(expected_entry.segm.segments, entry.segm.segments)
+                self.assertEqual(expected_entry.to_bytes(), entry.to_bytes())
+        self.assertEqual('special', entries[1].file_path)
+        self.assertEqual(0, entries[3].time.timestamp)
+
+    def test_corrupt(self):
+        """Truncated indexes and mismatched checksums raise instead of being accepted"""
+        index = self.make_index()
+        entries = XP3FileIndex.parse(index)
+        boundaries = {0}
+        for entry in entries:
+            boundaries.add(max(boundaries) + len(entry.to_bytes()))
+        for end in range(len(index)):
+            if end in boundaries:
+                self.assertEqual(len([b for b in boundaries if 0 < b <= end]), len(XP3FileIndex.parse(index[:end])))
+            else:
+                with self.assertRaises(AssertionError, msg=end):
+                    XP3FileIndex.parse(index[:end])
+
+        segment = XP3FileSegments.segment
+        for segments in ([segment(True, 16, 10, 5)], [segment(True, 16, 10, 5), segment(False, 21, 4, 4)]):
+            entry = XP3FileEntry(time=XP3FileTime(5000), adlr=XP3FileAdler(1), segm=XP3FileSegments(segments),
+                                 info=XP3FileInfo(True, 14, 9, 'hash'))
+            mismatched = XP3IndexSpecialFormat(2, 'special', b'neko').to_bytes() + entry.to_bytes()
+            with self.assertRaises(AssertionError):
+                XP3FileIndex.parse(mismatched)
+            with self.assertRaises(AssertionError):
+                XP3FileIndex.from_index(mismatched)
+
+    def test_columnar(self):
+        index = self.make_index()
+        file_index = XP3FileIndex.from_index(index)
+        self.assertEqual(4, len(file_index))
+        self.assertEqual(['plain', 'special', 'multiple', 'untimed'], [entry.file_path for entry in file_index])
+        self.assertEqual(2, len(file_index['multiple'].segm.segments))
+        self.assertEqual('untimed', file_index[-1].file_path)
+        self.assertEqual(file_index[1].to_bytes(), file_index['special'].to_bytes())
+        self.assertTrue(file_index.is_encrypted)
+        with self.assertRaises(IndexError):
+            file_index[4]
+        with self.assertRaises(KeyError):
+            file_index['missing']
+        # Serialising the columns gives the index back, including the untouched millisecond timestamps
+        rebuilt = XP3FileIndex.from_entries(list(file_index))
+        self.assertTrue(index.startswith(b''.join(rebuilt.entry_to_bytes(position) for position in range(3))))
+
+
+class ParallelExtract(unittest.TestCase):
+    """Pipelined extract must write the same files as the serial one"""
+
+    dummy_data = [('folder_{}/file_{}'.format(i % 3, i), bytes([i % 7]) * (i * 97) + os.urandom(i))
+                  for i in range(40)]
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with open(xp3_path, 'wb') as buffer, XP3Writer(buffer, silent=True, compressed=True) as xp3:
+                for filepath, data in self.dummy_data:
+                    xp3.add(filepath, data)
+
+            for use_mmap in (False, True):
+                with XP3(xp3_path, mode='r', silent=True, use_mmap=use_mmap) as xp3:
+                    xp3.extract(os.path.join(xp3dir, 'serial'))
+                    xp3.extract(os.path.join(xp3dir, 'parallel'), workers=4)
+
+                for filepath, data in self.dummy_data:
+                    for out in ('serial', 'parallel'):
+                        with open(os.path.join(xp3dir, out, filepath), 'rb') as file:
+                            self.assertEqual(data, file.read())
+
+
+class ParallelWrite(unittest.TestCase):
+    """Archive packed with workers must be identical to the one packed serially"""
+
+    dummy_data = ParallelExtract.dummy_data
+
+    def pack(self, game_name, **kwargs):
+        crypt_class, params, _ = game_list[game_name]
+        with XP3Writer(silent=True, game_name=game_name, encrypt_instance=crypt_class(**params), compressed=True,
+                       **kwargs) as xp3:
+            for filepath, data in self.dummy_data:
+                xp3.add(filepath, data)
+            return xp3.pack_up()
+
+    def test(self):
+        for game_name in ('none', 'neko_vol0'):
+            expected = self.pack(game_name)
+            self.assertEqual(expected, self.pack(game_name, workers=4))
+            self.assertEqual(expected, self.pack(game_name, workers=3, max_inflight_bytes=1000))
+
+    def test_block_size(self):
+        """Big files are compressed in blocks even by a single worker, so the archive stays the same"""
+        for game_name in ('none', 'neko_vol0'):
+            expected = self.pack(game_name, block_size=1000)
+            self.assertNotEqual(self.pack(game_name), expected)
+            self.assertEqual(expected, self.pack(game_name, workers=4, block_size=1000))
+            self.assertEqual(expected, self.pack(game_name, workers=3, block_size=1000, max_inflight_bytes=1000))
+
+
+class StreamWrite(unittest.TestCase):
+    """Files added from a stream in chunks must read back the same as files added at once"""
+
+    dummy_data = (
+        ('compressed_file', b'0123456789' * 1000),
+        ('stored_file', os.urandom(3000)),
+        ('empty_file', b''),
+    )
+
+    def test(self):
+        for game_name in game_list:
+            crypt_class, params, _ = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for compressed in (False, True):
+                with XP3Writer(silent=True, use_numpy=False, game_name=game_name,
+                               encrypt_instance=encrypt_instance, compressed=compressed) as xp3:
+                    for filepath, data in self.dummy_data:
+                        xp3.add(filepath, data)
+                        xp3.add_stream('streamed/' + filepath, BytesIO(data), chunk_size=100)
+                    archive = xp3.pack_up()
+
+                with XP3Reader(archive, silent=True, use_numpy=False) as xp3:
+                    for filepath, data in self.dummy_data:
+                        expected, streamed = xp3.open(filepath), xp3.open('streamed/' + filepath)
+                        self.assertEqual(expected.adler32, streamed.adler32)
+                        self.assertEqual(expected.segm[0].is_compressed, streamed.segm[0].is_compressed)
+                        self.assertEqual(data, streamed.read(game_name, encrypt_instance=encrypt_instance))
+
+
+class StreamRead(unittest.TestCase):
+    """Reading a file as a stream gives the same data as reading it at once"""
+
+    def test(self):
+        data = b'0123456789' * 5000 + os.urandom(5000)
+        for game_name in game_list:
+            crypt_class, params, _ = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for compressed in (False, True):
+                with XP3Writer(silent=True, use_numpy=False, game_name=game_name,
+                               encrypt_instance=encrypt_instance, compressed=compressed) as xp3:
+                    xp3.add('file', data)
+                    archive = xp3.pack_up()
+
+                with XP3Reader(archive, silent=True, use_numpy=False, game_name=game_name,
+                               encrypt_instance=encrypt_instance) as xp3:
+                    with xp3.open('file', stream=True, verify=True, chunk_size=1000) as stream:
+                        chunks = iter(lambda: stream.read(777), b'')
+                        self.assertEqual(data, b''.join(chunks))
+                        self.assertEqual(len(data), stream.tell())
+                    with xp3.open('file', stream=True) as stream:
+                        self.assertEqual(data, stream.read())
+
+    def test_checksum(self):
+        with XP3Writer(silent=True) as xp3:
+            xp3.add('file', b'dummydata')
+            archive = bytearray(xp3.pack_up())
+        archive[archive.index(b'dummydata')] ^= 1
+
+        with XP3Reader(bytes(archive), silent=True) as xp3:
+            with self.assertRaises(XP3ChecksumError):
+                xp3.open('file', stream=True, verify=True).read()
+            # Seeking to where the stream already is keeps verifying
+            stream = xp3.open('file', stream=True, verify=True)
+            stream.read(4)
+            stream.seek(4)
+            stream.seek(0, io.SEEK_CUR)
+            with self.assertRaises(XP3ChecksumError):
+                stream.read()
+
+
+class RangeRead(unittest.TestCase):
+    """Byte ranges and seeking inside a file"""
+
+    ranges = ((0, 10), (5, 1), (31, 66), (1000, 30000), (49990, 100), (60000, 10), (0, 60000))
+
+    def test(self):
+        data = b'0123456789' * 5000 + os.urandom(5000)
+        for game_name in game_list:
+            crypt_class, params, _ = game_list[game_name]
+            encrypt_instance = crypt_class(**params)
+            for compressed in (False, True):
+                with XP3Writer(silent=True, use_numpy=False, game_name=game_name,
+                               encrypt_instance=encrypt_instance, compressed=compressed) as xp3:
+                    xp3.add('file', data)
+                    archive = xp3.pack_up()
+
+                with XP3Reader(archive, silent=True, use_numpy=False, game_name=game_name,
+                               encrypt_instance=encrypt_instance) as xp3:
+                    file = xp3.open('file')
+                    for offset, length in self.ranges:
+                        self.assertEqual(data[offset:offset + length],
+                                         file.read_range(offset, length, game_name, encrypt_instance=encrypt_instance))
+
+                    with io.BufferedReader(xp3.open('file', stream=True, chunk_size=4096)) as stream:
+                        self.assertTrue(stream.seekable())
+                        for offset, length in reversed(self.ranges):
+                            self.assertEqual(offset, stream.seek(offset))
+                            self.assertEqual(data[offset:offset + length], stream.read(length))
+                        stream.seek(-10, os.SEEK_END)
+                        self.assertEqual(data[-10:], stream.read())
+                        stream.seek(100)
+                        stream.seek(50, os.SEEK_CUR)
+                        self.assertEqual(150, stream.tell())
+                        self.assertEqual(data[150:160], stream.read(10))
+
+
+class AppendWrite(unittest.TestCase):
+    """Adding and replacing files of an existing archive"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with open(xp3_path, 'wb') as buffer, XP3Writer(buffer, silent=True, compressed=True) as xp3:
+                xp3.add('kept', b'kept' * 100, timestamp=1234567)
+                xp3.add('replaced', b'old data')
+
+            with XP3(xp3_path, mode='r', silent=True) as xp3:
+                kept = xp3.open('kept')
+
+            with XP3(xp3_path, mode='a', silent=True) as xp3:
+                xp3.add('replaced', b'new data', replace=True)
+                xp3.add('added', b'added data')
+                with self.assertRaises(FileExistsError):
+                    xp3.add('kept', b'')
+
+            with XP3(xp3_path, mode='r', silent=True) as xp3:
+                self.assertEqual(['kept', 'replaced', 'added'], [file.file_path for file in xp3])
+                self.assertEqual(kept.segm.segments, xp3.open('kept').segm.segments)
+                self.assertEqual(kept.time.raw, xp3.open('kept').time.raw)
+                self.assertEqual(b'kept' * 100, xp3.open('kept').read())
+                self.assertEqual(b'new data', xp3.open('replaced').read())
+                self.assertEqual(b'added data', xp3.open('added').read())
+
+    def test_remove(self):
+        """Files of the archive and files just added can be removed and added again"""
+        with XP3Writer(silent=True) as xp3:
+            for i in range(5):
+                xp3.add('file{}'.format(i), bytes([i]) * 10)
+            archive = xp3.pack_up()
+
+        with XP3Writer(BytesIO(archive), silent=True, append=True) as xp3:
+            xp3.remove('file1')
+            xp3.add('file1', b'new 1')
+            xp3.add('file3', b'new 3', replace=True)
+            xp3.add('new', b'new')
+            xp3.remove('new')
+            xp3.add('file5', b'new 5')
+            with self.assertRaises(FileNotFoundError):
+                xp3.remove('new')
+            with self.assertRaises(FileNotFoundError):
+                xp3.remove('file3x')
+            self.assertEqual(['file0', 'file2', 'file4', 'file1', 'file3', 'file5'],
+                             [entry.file_path for entry in xp3.file_entries])
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            self.assertEqual(['file0', 'file2', 'file4', 'file1', 'file3', 'file5'], [file.file_path for file in xp3])
+            self.assertEqual(b'new 3', xp3.open('file3').read())
+            self.assertEqual(b'\4' * 10, xp3.open('file4').read())
+
+
+class Transform(unittest.TestCase):
+    """Archive to archive transform only decodes the selected files and copies the others as stored"""
+
+    dummy_data = (
+        ('voice/line.ogg', b'voice data ' * 100),
+        ('scenario/first.ks', b'script ' * 100),
+        ('image.png', os.urandom(1000)),
+    )
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            src_path, dst_path = os.path.join(xp3dir, 'src.xp3'), os.path.join(xp3dir, 'dst.xp3')
+            for encryption in ('none', 'neko_vol0', 'sousaku_kanojo'):
+                with XP3(src_path, mode='w', silent=True, encryption=encryption) as xp3:
+                    for filepath, data in self.dummy_data:
+                        xp3.add(filepath, data, timestamp=1234567)
+
+                with XP3(src_path, mode='r', silent=True, encryption=encryption) as src, \
+                        XP3(dst_path, mode='w', silent=True, encryption=encryption) as dst:
+                    XP3.transform(src, dst, lambda name: name.endswith('.ogg'), lambda name, data: data.upper())
+
+                with XP3(src_path, mode='r', silent=True, encryption=encryption) as src, \
+                        XP3(dst_path, mode='r', silent=True, encryption=encryption) as dst:
+                    for filepath, data in self.dummy_data:
+                        file = dst.open(filepath)
+                        expected = data.upper() if filepath.endswith('.ogg') else data
+                        self.assertEqual(expected, file.read(encryption, encrypt_instance=dst.encrypt_instance))
+                        self.assertEqual(src.open(filepath).time.raw, file.time.raw)
+                        if not filepath.endswith('.ogg'):
+                            self.assertEqual(src.open(filepath).read_segments(), file.read_segments())
+                            self.assertEqual(src.open(filepath).info.file_path, file.info.file_path)
+
+    def test_encryption_mismatch(self):
+        """Files copied as stored would not be readable with another encryption"""
+        with tempfile.TemporaryDirectory() as xp3dir:
+            src_path, dst_path = os.path.join(xp3dir, 'src.xp3'), os.path.join(xp3dir, 'dst.xp3')
+            with XP3(src_path, mode='w', silent=True, encryption='neko_vol0') as xp3:
+                xp3.add('image.png', b'image')
+            with XP3(src_path, mode='r', silent=True, encryption='neko_vol0') as src, \
+                    XP3(dst_path, mode='w', silent=True, encryption='sousaku_kanojo') as dst:
+                with self.assertRaises(ValueError):
+                    XP3.transform(src, dst, lambda name: False, None)
+
+    def test_budget(self):
+        """Concurrent transform sharing a budget smaller than the files gives it all back"""
+        with tempfile.TemporaryDirectory() as xp3dir:
+            src_path, dst_path = os.path.join(xp3dir, 'src.xp3'), os.path.join(xp3dir, 'dst.xp3')
+            with XP3(src_path, mode='w', silent=True) as xp3:
+                for i in range(20):
+                    xp3.add('voice/{}.ogg'.format(i), bytes([i]) * 1000)
+
+            budget = ByteBudget(1500)
+            with ThreadPoolExecutor(4) as executor, XP3(src_path, mode='r', silent=True) as src, \
+                    XP3(dst_path, mode='w', silent=True) as dst:
+                XP3.transform(src, dst, lambda name: True, lambda name, data: data[::-1], executor, 4, budget)
+            self.assertEqual(0, budget.used)
+
+            with XP3(dst_path, mode='r', silent=True) as xp3:
+                self.assertEqual([bytes([i]) * 1000 for i in range(20)], [file.read() for file in xp3])
+
+
+class BatchProcess(unittest.TestCase):
+    """A failed batch run leaves the archive as it was, an existing backup is never overwritten"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir, ThreadPoolExecutor(2) as executor:
+            path = Path(xp3dir) / 'voice.xp3'
+            with XP3(str(path), mode='w', silent=True, encryption='neko_vol0') as xp3:
+                xp3.add('a.ks', b'script ' * 100)
+                xp3.add('b.ogg', b'voice ' * 100)
+            original = path.read_bytes()
+
+            with self.assertRaises(XP3DecryptionError):  # Encryption not specified
+                process_xp3(path, 'none', 1.5, executor)
+            self.assertEqual(original, path.read_bytes())
+            self.assertEqual(['voice.xp3'], os.listdir(xp3dir))
+
+            process_xp3(path, 'neko_vol0', 1.5, executor)
+            self.assertEqual(original, path.with_suffix('.xp3.bak').read_bytes())
+            with XP3(str(path), mode='r', silent=True, encryption='neko_vol0') as xp3:
+                self.assertEqual(b'script ' * 100, xp3.open('a.ks').read('neko_vol0',
+                                                                         encrypt_instance=xp3.encrypt_instance))
+
+            path.with_suffix('.xp3.bak').write_bytes(b'first original')
+            process_xp3(path, 'neko_vol0', 1.5, executor)
+            self.assertEqual(b'first original', path.with_suffix('.xp3.bak').read_bytes())
+            self.assertEqual(['voice.xp3', 'voice.xp3.bak'], sorted(os.listdir(xp3dir)))
+
+
+class Dedup(unittest.TestCase):
+    """Files with the same content share their segments, files only sharing a checksum do not"""
+
+    def test(self):
+        same = os.urandom(1000) + b'\0' * 1000
+        for encryption in ('none', 'neko_vol0', 'sousaku_kanojo'):
+            for workers in (1, 4):
+                with XP3(BytesIO(), mode='w', silent=True, encryption=encryption, workers=workers,
+                         dedup=True) as xp3:
+                    xp3.add('first', same)
+                    xp3.add('unique', b'unique' * 100)
+                    xp3.add('second', same)
+                    xp3.add('third', same, timestamp=1234567)
+                    # Same size and Adler-32, different content
+                    xp3.add('collision_a', bytes([1, 0, 0, 1]))
+                    xp3.add('collision_b', bytes([0, 1, 1, 0]))
+                    archive = xp3.pack_up()
+                    self.assertEqual(2, xp3.deduplicated_files)
+
+                with XP3(BytesIO(archive), mode='r', silent=True, encryption=encryption) as xp3:
+                    def read(filepath):
+                        return xp3.open(filepath).read(encryption, encrypt_instance=xp3.encrypt_instance)
+
+                    for filepath in ('second', 'third'):
+                        self.assertEqual(xp3.open('first').segm.segments, xp3.open(filepath).segm.segments)
+                        self.assertEqual(same, read(filepath))
+                    self.assertEqual(1234567, xp3.open('third').time.raw)
+                    self.assertNotEqual(xp3.open('collision_a').segm.segments,
+                                        xp3.open('collision_b').segm.segments)
+                    self.assertEqual(bytes([0, 1, 1, 0]), read('collision_b'))
+
+
+class Compression(unittest.TestCase):
+    """Compression policy stores already compressed formats and files that do not shrink when probed"""
+
+    def test(self):
+        policy = CompressionPolicy(levels={'.tlg': 0, '.OGG': 1})
+        self.assertEqual(0, policy.level_for('image.png', b'a' * 1000))
+        self.assertEqual(0, policy.level_for('image.tlg', b'a' * 1000))
+        self.assertEqual(1, policy.level_for('VOICE.ogg', b'a' * 1000))
+        self.assertEqual(9, policy.level_for('scenario.ks', b'a' * 1000))
+        self.assertEqual(6, policy.level_for('movie.dat', b'a' * 1000, size=100 * 1024 * 1024))
+        self.assertEqual(0, policy.level_for('noise.dat', os.urandom(100 * 1024)))
+        self.assertEqual(9, CompressionPolicy.always().level_for('noise.ogg', os.urandom(100 * 1024)))
+
+        text = b'text ' * 100000
+        with XP3Writer(silent=True, compressed=True, policy=policy) as xp3:
+            xp3.add('music.ogg', text)
+            xp3.add('scenario.ks', text)
+            xp3.add_stream('stream.ogg', BytesIO(text), chunk_size=1000)
+            xp3.add_stream('stream.ks', BytesIO(text), chunk_size=1000)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            self.assertTrue(xp3.open('music.ogg').segm[0].is_compressed)  # .ogg is level 1 here
+            self.assertTrue(xp3.open('scenario.ks').segm[0].is_compressed)
+            self.assertEqual(text, xp3.open('stream.ks').read())
+
+        with XP3Writer(silent=True, compressed=True, policy=CompressionPolicy()) as xp3:
+            xp3.add('music.ogg', text)
+            xp3.add_stream('stream.ogg', BytesIO(text), chunk_size=1000)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            for file in xp3:
+                self.assertFalse(file.segm[0].is_compressed)
+                self.assertEqual(text, file.read())
+
+
+class BlockCompress(unittest.TestCase):
+    """Big files compressed in blocks on several threads still form a single zlib stream"""
+
+    def test(self):
+        data = (os.urandom(3000) + b'block ' * 5000) * 20
+        self.assertEqual(zlib.adler32(data), adler32_combine(zlib.adler32(data[:12345]), zlib.adler32(data[12345:]),
+                                                             len(data) - 12345))
+        with ThreadPoolExecutor(4) as executor:
+            compressor = BlockCompressor(9, executor, 10000, depth=2)
+            compressed = b''.join(compressor.compress(data[i:i + 7777]) for i in range(0, len(data), 7777))
+            self.assertEqual(data, zlib.decompress(compressed + compressor.flush()))
+
+        for encryption in ('none', 'sousaku_kanojo'):
+            with XP3(BytesIO(), mode='w', silent=True, encryption=encryption, workers=4, block_size=10000) as xp3:
+                xp3.add('big', data)
+                xp3.add_stream('streamed', BytesIO(data), chunk_size=7777)
+                xp3.add('small', data[:15000])
+                archive = xp3.pack_up()
+
+            with XP3(BytesIO(archive), mode='r', silent=True, encryption=encryption) as xp3:
+                for file in xp3:
+                    self.assertTrue(file.segm[0].is_compressed)
+                    self.assertEqual(data[:file.info.uncompressed_size],
+                                     file.read(encryption, encrypt_instance=xp3.encrypt_instance))
+
+
+class MultiSegment(unittest.TestCase):
+    """Files split in segments decode to the whole file, serially, concurrently, streamed and by range"""
+
+    def test(self):
+        data = b'segment ' * 2000 + os.urandom(20000) + b'segment ' * 2000
+        for encryption in ('none', 'neko_vol0', 'sousaku_kanojo'):
+            for workers in (1, 4):
+                with XP3(BytesIO(), mode='w', silent=True, encryption=encryption, workers=workers,
+                         segment_size=16000) as xp3:
+                    xp3.add('added', data)
+                    xp3.add_stream('streamed', BytesIO(data), chunk_size=7777)
+                    archive = xp3.pack_up()
+
+                with XP3(BytesIO(archive), mode='r', silent=True, encryption=encryption) as xp3, \
+                        ThreadPoolExecutor(4) as executor:
+                    for file in xp3:
+                        self.assertEqual(4, len(file.segm.segments))
+                        # Only the segment that is random all the way is stored
+                        self.assertEqual([True, False, True, True], [s.is_compressed for s in file.segm])
+                        read = dict(encryption_type=encryption, encrypt_instance=xp3.encrypt_instance)
+                        self.assertEqual(data, file.read(**read))
+                        self.assertEqual(data, file.read(executor=executor, **read))
+                        self.assertEqual(data[9000:31000], file.read_range(9000, 22000, **read))
+
+
+class IncrementalRepack(unittest.TestCase):
+    """Files unchanged since the base archive are copied from it, changed and new ones are packed"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as folder:
+            files = {'same.ks': b'same ' * 100, 'changed.ks': b'before', 'resized.ks': b'before', 'gone.ks': b'gone'}
+            base_path, new_path = os.path.join(folder, 'base.xp3'), os.path.join(folder, 'new.xp3')
+            source = os.path.join(folder, 'source')
+            os.makedirs(os.path.join(source, 'scenario'))
+
+            def write(files):
+                for name in os.listdir(os.path.join(source, 'scenario')):
+                    os.remove(os.path.join(source, 'scenario', name))
+                for name, data in files.items():
+                    with open(os.path.join(source, 'scenario', name), 'wb') as file:
+                        file.write(data)
+
+            write(files)
+            with XP3(base_path, 'w', silent=True, encryption='neko_vol0') as xp3:
+                xp3.add_folder(source)
+
+            del files['gone.ks']
+            files.update({'changed.ks': b'after!', 'resized.ks': b'much longer', 'new.ks': b'new'})
+            write(files)
+            with XP3(base_path, 'r', silent=True, encryption='neko_vol0') as base, \
+                    XP3(new_path, 'w', silent=True, encryption='neko_vol0') as xp3:
+                xp3.add_folder(source, base=base)
+                self.assertEqual(1, xp3.reused_files)
+                same = base.open('scenario/same.ks').segm.segments
+
+            with XP3(new_path, 'r', silent=True, encryption='neko_vol0') as xp3:
+                self.assertEqual(sorted('scenario/' + name for name in files), sorted(file.file_path for file in xp3))
+                for name, data in files.items():
+                    file = xp3.open('scenario/' + name)
+                    self.assertEqual(data, file.read('neko_vol0', encrypt_instance=xp3.encrypt_instance))
+                self.assertEqual(same[0].compressed_size, xp3.open('scenario/same.ks').segm[0].compressed_size)
+
+    def test_quick(self):
+        """Quick repacks take files with the same size and modification time as unchanged"""
+        with tempfile.TemporaryDirectory() as folder:
+            path, base_path = os.path.join(folder, 'file.ks'), os.path.join(folder, 'base.xp3')
+            with open(path, 'wb') as file:
+                file.write(b'before')
+            os.utime(path, (1000, 1000))
+            with XP3(base_path, 'w', silent=True) as xp3:
+                xp3.add_file(path, save_timestamps=True)
+
+            def repack(times):
+                with open(path, 'wb') as file:
+                    file.write(b'after!')
+                os.utime(path, times)
+                with XP3(base_path, 'r', silent=True) as base, XP3(BytesIO(), 'w', silent=True) as xp3:
+                    xp3.add_file(path, save_timestamps=True, base=base, quick=True)
+                    return xp3.reused_files
+
+            self.assertEqual(0, repack((1000, 2000)))  # Only the access time matches, the file counts as changed
+            self.assertEqual(1, repack((2000, 1000)))
+
+    def test_encryption_mismatch(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'file.ks')
+            with open(path, 'wb') as file:
+                file.write(b'data')
+            with XP3(BytesIO(), 'w', silent=True, encryption='neko_vol0') as xp3:
+                xp3.add_file(path)
+                archive = xp3.pack_up()
+            with XP3(BytesIO(archive), 'r', silent=True, encryption='neko_vol0') as base, \
+                    XP3(BytesIO(), 'w', silent=True) as xp3:
+                with self.assertRaises(ValueError):
+                    xp3.add_file(path, base=base)
+
+
+class Cache(unittest.TestCase):
+    """On-disk cache counts hits and misses and evicts the least recently used entries"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache = DiskCache(cachedir, 2500)
+            keys = [DiskCache.key('file', i) for i in range(3)]
+            self.assertIsNone(cache.get(keys[0]))
+            for i, key in enumerate(keys[:2]):
+                cache.put(key, bytes([i]) * 1000)
+                os.utime(os.path.join(cachedir, key[:2], key), (i, i))
+            self.assertEqual(b'\0' * 1000, cache.get(keys[0]))  # Now the most recently used one
+            cache.put(keys[2], b'\2' * 1000)
+            self.assertIsNone(cache.get(keys[1]))
+            self.assertEqual(b'\2' * 1000, cache.get(keys[2]))
+            self.assertEqual((2, 2), (cache.hits, cache.misses))
+            # A new instance picks up what is already there
+            self.assertEqual(2000, DiskCache(cachedir, 2500)._size)
+
+    def test_writer(self):
+        """Packing the same files again with the same settings is served from the cache"""
+        files = (('scenario.ks', b'script ' * 1000), ('image.png', os.urandom(1000)), ('copy.ks', b'script ' * 1000))
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache = DiskCache(cachedir, 1024 * 1024)
+            archives = []
+            for encryption in ('neko_vol0', 'neko_vol0', 'sousaku_kanojo'):
+                with XP3(BytesIO(), mode='w', silent=True, encryption=encryption, segment_size=3000,
+                         cache=cache) as xp3:
+                    for filepath, data in files:
+                        xp3.add(filepath, data)
+                    archives.append(xp3.pack_up())
+            # copy.ks and the whole second archive are hits, another encryption only shares copy.ks
+            self.assertEqual((5, 4), (cache.hits, cache.misses))
+            self.assertEqual(archives[0], archives[1])
+
+            with XP3(BytesIO(archives[1]), mode='r', silent=True, encryption='neko_vol0') as xp3:
+                for filepath, data in files:
+                    self.assertEqual(data, xp3.open(filepath).read('neko_vol0', encrypt_instance=xp3.encrypt_instance))
+
+    def test_writer_key(self):
+        """Schemes that only differ by their keys and different block sizes do not share cached files"""
+        class Xor(EncryptInterface):  # Default __str__, without the key
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+                self.key = kwargs['key']
+
+            def encrypt_buffer(self, buffer, adler32, offset=0, use_numpy=True):
+                xor_byte(buffer, self.key, use_numpy)
+
+        data = b'script ' * 1000
+        with tempfile.TemporaryDirectory() as cachedir:
+            cache = DiskCache(cachedir, 1024 * 1024)
+            archives = []
+            for key, block_size in ((1, None), (2, None), (2, 1000)):
+                with XP3Writer(silent=True, game_name='neko_vol0', encrypt_instance=Xor(key=key), compressed=True,
+                               block_size=block_size, cache=cache) as xp3:
+                    xp3.add('scenario.ks', data)
+                    archives.append(xp3.pack_up())
+            self.assertEqual((0, 3), (cache.hits, cache.misses))
+            self.assertEqual(3, len(set(archives)))
+
+
+class PhaseStats(unittest.TestCase):
+    """Time and bytes of every phase are reported into stats and progress goes to the callback"""
+
+    def test(self):
+        files = {'scenario.ks': b'script ' * 1000, 'image.png': os.urandom(3000)}
+        stats, progress = Stats(), []
+        with XP3(BytesIO(), mode='w', compressed=True, encryption='neko_vol0', stats=stats,
+                 progress=lambda action, file_entry: progress.append((action, file_entry.file_path))) as xp3:
+            for filepath, data in files.items():
+                xp3.add(filepath, data)
+            archive = xp3.pack_up()
+        self.assertEqual([('pack', filepath) for filepath in files], progress)
+        self.assertEqual(10000, stats.bytes['checksum'])
+        self.assertEqual(10000, stats.bytes['encrypt'])
+        self.assertEqual(len(archive) - len(XP3Signature) - 8, stats.bytes['write'])  # All but the header
+        self.assertEqual(2, stats.calls['compress'])
+
+        stats = Stats()
+        with tempfile.TemporaryDirectory() as folder, \
+                XP3(BytesIO(archive), mode='r', silent=True, encryption='neko_vol0', stats=stats) as xp3:
+            xp3.extract(folder, 'neko_vol0')
+        self.assertEqual(1, stats.calls['index'])
+        self.assertEqual(10000, stats.bytes['decrypt'])
+        self.assertEqual(10000, stats.bytes['checksum'])
+        self.assertEqual(10000, stats.bytes['write'])
+        self.assertEqual(7000, stats.bytes['decompress'])  # The image does not shrink and is stored
+        self.assertIn('decompress', stats.report())
+
+
 class DuplicateWrite(unittest.TestCase):
     """Make sure that duplicates can not be added into archive"""
 
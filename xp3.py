@@ -13,7 +13,12 @@
 # Python 3 rewrite, Awakening
 
 
-import os, argparse
+import os, argparse, zlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from pipeline import ordered, ByteBudget
+from compression import CompressionPolicy
+from cache import DiskCache
+from stats import Stats
 from xp3reader import XP3Reader
 from xp3writer import XP3Writer
 
@@ -24,22 +29,61 @@ encrypt_instance: EncryptInterface = None
 game_name: str = 'none'
 
 class XP3(XP3Reader, XP3Writer):
-    def __init__(self, target, mode='r', silent=False, compressed=True):
+    # Files bigger than this are streamed into the archive instead of being read into memory
+    stream_threshold = 64 * 1024 * 1024
+
+    def __init__(self, target, mode='r', silent=False, compressed=True, use_mmap=False, workers: int = 1,
+                 max_inflight_bytes: int = 256 * 1024 * 1024, encryption: str = None, dedup: bool = False,
+                 policy: CompressionPolicy = None, block_size: int = None, segment_size: int = None,
+                 cache: DiskCache = None, stats: Stats = None, progress=None):
+        """
+        :param workers: Number of worker threads used to extract or pack files
+        :param max_inflight_bytes: How many bytes of files may wait for the packing workers
+        :param encryption: Encryption from game_list, the one chosen on the command line if not specified
+        :param dedup: Store files with identical content only once when packing
+        :param policy: Picks the level each file is compressed at, everything at level 9 if not specified
+        :param block_size: Big files are compressed in blocks of this size on all workers,
+                           which changes the archive a little (see XP3Writer)
+        :param segment_size: Split files bigger than this in segments of this size when packing
+        :param cache: Reuse the compressed and encrypted data of files packed before with the same settings
+        :param stats: Report the time and bytes spent in every phase of extracting or packing into it
+        :param progress: progress(action, file_entry) called for every file extracted or packed
+                         instead of printing a line for it (see stats.print_progress)
+        """
         self.mode = mode
+        self.workers = workers
+        self.reused_files = 0  # Copied from a base archive by add_folder
+        if encryption is None:
+            name, instance = game_name, encrypt_instance
+        else:
+            crypt_class, params, _ = game_list[encryption]
+            name, instance = encryption, crypt_class(**params)
 
         if self._is_readmode:
             if isinstance(target, str):
                 if not os.path.isfile(target):
                     raise FileNotFoundError
                 target = open(target, 'rb')
-            XP3Reader.__init__(self, target, silent, True, game_name, encrypt_instance)
-        elif self._is_writemode:
+            XP3Reader.__init__(self, target, silent, True, name, instance, use_mmap, stats, progress)
+        elif self.mode == 'w':
             if isinstance(target, str):
                 dir = os.path.dirname(target)
                 if dir and not os.path.exists(dir):
                     os.makedirs(dir)
-                target = open(target, 'wb')
-            XP3Writer.__init__(self, target, silent, True, game_name, encrypt_instance, compressed)
+                target = open(target, 'w+b')  # Readable too, dedup reads files back
+            XP3Writer.__init__(self, target, silent, True, name, instance, compressed, workers,
+                               max_inflight_bytes, dedup=dedup, policy=policy,
+                               block_size=block_size, segment_size=segment_size, cache=cache,
+                               stats=stats, progress=progress)
+        elif self._is_appendmode:
+            if isinstance(target, str):
+                if not os.path.isfile(target):
+                    raise FileNotFoundError
+                target = open(target, 'r+b')
+            XP3Writer.__init__(self, target, silent, True, name, instance, compressed, workers,
+                               max_inflight_bytes, append=True, dedup=dedup, policy=policy,
+                               block_size=block_size, segment_size=segment_size, cache=cache,
+                               stats=stats, progress=progress)
         else:
             raise ValueError('Invalid operation mode')
 
@@ -49,30 +93,139 @@ class XP3(XP3Reader, XP3Writer):
 
     @property
     def _is_writemode(self):
-        return True if self.mode == 'w' else False
+        return True if self.mode in ('w', 'a') else False
+
+    @property
+    def _is_appendmode(self):
+        return True if self.mode == 'a' else False
 
-    def extract(self, to='', encryption_type='none'):
-        """Extract all files in the archive to specified folder"""
+    def extract(self, to='', encryption_type='none', workers: int = None):
+        """
+        Extract all files in the archive to specified folder
+        :param workers: Number of threads decompressing and decrypting files (the archive's by default),
+                        with more than one, reading, decoding and writing run concurrently
+        """
         if not self._is_readmode:
             raise Exception('Archive is not open in reading mode')
+        workers = self.workers if workers is None else workers
+        if workers > 1:
+            return self._extract_parallel(to, encryption_type, workers)
 
         for file in self:
             try:
-                if not self.silent:
-                    print('| Extracting {} ({} -> {} bytes)'.format(file.file_path,
-                                                                    file.info.compressed_size,
-                                                                    file.info.uncompressed_size))
-                file.extract(to=to, encryption_type=encryption_type, encrypt_instance=encrypt_instance)
+                if self.progress is not None:
+                    self.progress('extract', file)
+                file.extract(to=to, encryption_type=encryption_type, encrypt_instance=self.encrypt_instance)
             except OSError:  # Usually because of long file names
                 if not self.silent:
                     print('! Problem writing {}'.format(file.file_path))
         return self
 
-    def add_folder(self, path, flatten: bool = False, save_timestamps: bool = False):
+    def _extract_parallel(self, to, encryption_type, workers):
+        """
+        Pipelined extract: a reader thread pulls segments, the pool decompresses, decrypts and checksums them,
+        and files are written here in archive order, so the output and the log match a serial extract
+        The segments of files split in several are decoded on a second pool, the first one waits for them
+        """
+        def read(file):
+            return file, file.read_segments()
+
+        def decode(item):
+            file, segments = item
+            data = file.decode(segments, encryption_type=encryption_type, encrypt_instance=self.encrypt_instance,
+                               executor=segment_executor)
+            return data, file.verify(data)
+
+        with ThreadPoolExecutor(workers) as executor, ThreadPoolExecutor(workers) as segment_executor:
+            for (file, _), future in ordered(map(read, self), decode, executor, workers * 2):
+                try:
+                    if self.progress is not None:
+                        self.progress('extract', file)
+                    data, checksum_ok = future.result()
+                    if not checksum_ok and not self.silent:
+                        print('! Checksum error')
+                    file.save(data, to=to)
+                except OSError:  # Usually because of long file names
+                    if not self.silent:
+                        print('! Problem writing {}'.format(file.file_path))
+        return self
+
+    @staticmethod
+    def transform(src: 'XP3', dst: 'XP3', predicate, fn, executor: Executor = None, depth: int = 16,
+                  budget: ByteBudget = None):
+        """
+        Copy every file of an archive into another one, only decoding the files that are changed
+        :param src: Archive open for reading
+        :param dst: Archive open for writing, has to use the same encryption as src
+        :param predicate: predicate(file_path) tells if a file has to be changed
+        :param fn: fn(file_path, data) returns the new data of a changed file
+        :param executor: Run reading and fn of changed files on it, results are still added in archive order
+        :param depth: With an executor, how many files may be processed ahead of the one being written
+        :param budget: Shared budget the size of changed files is taken from until they are written,
+                       so several transforms can run at once without holding too much in memory
+        The other files are copied as they are stored, without decompressing, decrypting or recompressing them
+        """
+        if not src._is_readmode:
+            raise Exception('Source archive is not open in reading mode')
+        if not dst._is_writemode:
+            raise Exception('Destination archive is not open in writing mode')
+        if src.game_name != dst.game_name:
+            # Copied files keep their encrypted segments and special chunks
+            raise ValueError('Source archive uses {} encryption instead of {}'.format(src.game_name, dst.game_name))
+
+        def change(file):
+            if not predicate(file.file_path):
+                return None
+            data = file.read(encryption_type=src.game_name, encrypt_instance=src.encrypt_instance)
+            return fn(file.file_path, bytes(data))
+
+        acquired = [0]  # Bytes taken from the budget by the reading side
+
+        def files():
+            for file in src:
+                if budget is not None and predicate(file.file_path):
+                    budget.acquire(file.info.uncompressed_size)
+                    acquired[0] += file.info.uncompressed_size
+                yield file
+
+        if executor is None:
+            pending = None
+            results = ((file, change(file)) for file in files())
+        else:
+            pending = ordered(files(), change, executor, depth)
+            results = ((file, future.result()) for file, future in pending)
+
+        released = 0
+        try:
+            for file, data in results:
+                if data is None:
+                    dst.add_raw(file, replace=dst._is_appendmode)
+                else:
+                    dst.add(file.file_path, data, file.time.raw, replace=dst._is_appendmode)
+                    if budget is not None:
+                        budget.release(file.info.uncompressed_size)
+                        released += file.info.uncompressed_size
+        finally:
+            if pending is not None:
+                pending.close()  # Stops the reader before looking at what it still holds
+            if budget is not None and acquired[0] != released:
+                budget.release(acquired[0] - released)
+        return dst
+
+    def add_folder(self, path, flatten: bool = False, save_timestamps: bool = False, base: 'XP3' = None,
+                   quick: bool = False):
+        """
+        :param base: Previous build of the archive open for reading, files found in it with the same size and
+                     checksum are copied from it as they are stored instead of being compressed and encrypted again
+                     (it has to use the same encryption as this archive)
+        :param quick: With a base and save_timestamps, take files with the same size and modification time
+                      as unchanged without reading them
+        """
         if not self._is_writemode:
             raise Exception('Archive is not open in writing mode')
         if not self.silent:
             print('Packing {}'.format(path))
+        reused_files = self.reused_files
         for dirpath, dirs, filenames in os.walk(path):
             # Strip off the base directory and possible slash
             internal_root = dirpath[len(path) + 1:]
@@ -84,14 +237,19 @@ class XP3(XP3Reader, XP3Writer):
                 internal_filepath = internal_root + '/' + filename \
                                     if internal_root and not flatten \
                                     else filename
-                self.add_file(os.path.join(dirpath, filename), internal_filepath, save_timestamps)
+                self.add_file(os.path.join(dirpath, filename), internal_filepath, save_timestamps, base, quick)
+        if base is not None and not self.silent:
+            print('Reused {} unchanged files from the base archive'.format(self.reused_files - reused_files))
 
-    def add_file(self, path, internal_filepath: str = None, save_timestamps: bool = False):
+    def add_file(self, path, internal_filepath: str = None, save_timestamps: bool = False, base: 'XP3' = None,
+                 quick: bool = False):
         """
         :param path: Path to file
         :param internal_filepath: Internal archive path to save file under (if not specified, file name is used)
         :param encryption_type: Encryption type to use
-        :param save_timestamps: Save the file creating time into archive or not
+        :param save_timestamps: Save the file modification time into archive or not
+        :param base: Copy the file from this archive if it has it unchanged, see add_folder
+        :param quick: Compare the modification time instead of the checksum, see add_folder
         """
         if not self._is_writemode:
             raise Exception('Archive is not open in writing mode')
@@ -99,20 +257,61 @@ class XP3(XP3Reader, XP3Writer):
         if not os.path.exists(path):
             raise FileNotFoundError
 
-        with open(path, 'rb') as buffer:
+        internal_filepath = internal_filepath or os.path.basename(path)
+        timestamp = 0 if not save_timestamps else round(os.path.getmtime(path) * 1000)
+        size = os.path.getsize(path)
+        base_file = self._base_file(base, internal_filepath, size)
+        if base_file is not None and quick and timestamp and base_file.time.raw == timestamp:
+            return self._reuse(base_file)
+
+        if size > self.stream_threshold:
+            with open(path, 'rb') as buffer:
+                if base_file is not None:
+                    adler32 = 1
+                    for chunk in iter(lambda: buffer.read(1024 * 1024), b''):
+                        with self.stats.measure('checksum', len(chunk)):
+                            adler32 = zlib.adler32(chunk, adler32)
+                    if adler32 == base_file.adler32:
+                        return self._reuse(base_file)
+                    buffer.seek(0)
+                self.add_stream(internal_filepath, buffer, timestamp, replace=self._is_appendmode)
+            return
+
+        with self.stats.measure('read', size), open(path, 'rb') as buffer:
             data = buffer.read()
-            if not internal_filepath:
-                internal_filepath = os.path.basename(buffer.name)
 
-        timestamp = 0 if not save_timestamps else round(os.path.getctime(path) * 1000)
-        super().add(internal_filepath, data, timestamp)
+        if base_file is not None:
+            with self.stats.measure('checksum', len(data)):
+                unchanged = zlib.adler32(data) == base_file.adler32
+            if unchanged:
+                return self._reuse(base_file)
+        super().add(internal_filepath, data, timestamp, replace=self._is_appendmode)
+
+    def _base_file(self, base: 'XP3', internal_filepath: str, size: int):
+        """The file of the base archive at the same path if it has the same size"""
+        if base is None:
+            return None
+        if base.game_name != self.game_name:
+            raise ValueError('Base archive uses {} encryption instead of {}'.format(base.game_name, self.game_name))
+        try:
+            base_file = base.open(internal_filepath)
+        except KeyError:
+            return None
+        return base_file if base_file.info.uncompressed_size == size else None
+
+    def _reuse(self, base_file):
+        """Copy an unchanged file from the base archive"""
+        self.add_raw(base_file, replace=self._is_appendmode)
+        self.reused_files += 1
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Write the file index in the archive as we leave the context manager"""
         if self._is_writemode:
             if not self.packed_up:
                 self.pack_up()
-        self.buffer.close()
+            self.buffer.close()
+        else:
+            self.close()
 
 
 if __name__ == '__main__':
@@ -123,7 +322,8 @@ if __name__ == '__main__':
 
 
     parser = argparse.ArgumentParser(description='KiriKiri .XP3 archive repacking and extraction tool')
-    parser.add_argument('-mode', '-m', choices=['e', 'r', 'extract', 'repack'], default='e', help='Operation mode')
+    parser.add_argument('-mode', '-m', choices=['e', 'r', 'a', 'extract', 'repack', 'append'], default='e',
+                        help='Operation mode, append adds or replaces the files of the folder in an existing archive')
     parser.add_argument('-silent', '-s', action='store_true', default=False)
     parser.add_argument('-flatten', '-f', action='store_true', default=False,
                         help='Ignore the subdirectories and pack the archive as if all files are in the root folder')
@@ -131,6 +331,45 @@ if __name__ == '__main__':
     parser.add_argument('-encryption', '-e', choices=game_list.keys(), default='none',
                         help='Specify the encryption method')
     parser.add_argument('-compress', '-c', action='store_true', default=False)
+    parser.add_argument('-mmap', action='store_true', default=False,
+                        help='Memory-map the archive when extracting instead of copying every segment out of it')
+    parser.add_argument('-workers', '-j', type=int, default=1,
+                        help='Number of worker threads for decompression/decryption and compression/encryption')
+    parser.add_argument('-inflight', type=int, default=256,
+                        help='Megabytes of files allowed to wait for the workers when packing')
+    parser.add_argument('-dedup', action='store_true', default=False,
+                        help='Store files with identical content only once when packing')
+    parser.add_argument('-policy', choices=['auto', 'always'], default='auto',
+                        help='With -compress, auto stores already compressed formats and files that barely shrink '
+                             'when trial compressed, always compresses everything')
+    parser.add_argument('-level', type=int, default=9, help='zlib level of files without a specific rule')
+    parser.add_argument('-large-level', type=int, default=6,
+                        help='zlib level of files over 16 MB without a specific rule (auto policy)')
+    parser.add_argument('-store', nargs='*', default=[], metavar='EXT',
+                        help='More extensions to store without compressing (auto policy), e.g. -store .tlg .ttf')
+    parser.add_argument('-no-probe', action='store_true', default=False,
+                        help='Do not trial compress samples of big files to skip incompressible ones')
+    parser.add_argument('-block-size', type=int, default=0,
+                        help='Compress files of at least twice this many megabytes in blocks of it on all workers, '
+                             'the archive is a little bigger and differs from one packed without it, '
+                             'whatever the number of workers, 0 compresses every file on a single thread')
+    parser.add_argument('-segment-size', type=int, default=0,
+                        help='Split files bigger than this many megabytes in segments compressed on their own, '
+                             'so they can be decoded in parallel, 0 keeps every file in one segment')
+    parser.add_argument('-cache', metavar='DIR', default=None,
+                        help='Keep compressed and encrypted files in this folder, repacking unchanged files '
+                             'with the same settings only copies them from there')
+    parser.add_argument('-cache-size', type=int, default=4096,
+                        help='Megabytes the cache may use before the least recently used files are removed')
+    parser.add_argument('-base', type=input_filepath, default=None,
+                        help='Previous build of the archive, unchanged files are copied from it without recompressing')
+    parser.add_argument('-no-timestamps', action='store_true', default=False,
+                        help='Do not save the modification time of files into the archive')
+    parser.add_argument('-quick', action='store_true', default=False,
+                        help='With -base, files with the same size and modification time as in it count as unchanged '
+                             '(only if both are packed with timestamps)')
+    parser.add_argument('-stats', action='store_true', default=False,
+                        help='Print the time and MB/s of every phase (index, read, decompress, decrypt, ...) at the end')
     parser.add_argument('input', type=input_filepath, help='File to unpack or folder to pack')
     parser.add_argument('output', help='Output folder to unpack into or output file to pack into')
     args = parser.parse_args()
@@ -138,13 +377,31 @@ if __name__ == '__main__':
     crypt_class, params, _ = game_list[args.encryption]
     encrypt_instance = crypt_class(**params)
     game_name = args.encryption
+    stats = Stats() if args.stats else None
 
     if args.mode in ('e', 'extract'):
-        with XP3(args.input, 'r', args.silent) as xp3:
+        with XP3(args.input, 'r', args.silent, use_mmap=args.mmap, workers=args.workers, stats=stats) as xp3:
             if args.dump_index:
                 xp3.file_index.extract(args.output)
             else:
                 xp3.extract(args.output, args.encryption)
-    elif args.mode in ('r', 'repack'):
-        with XP3(args.output, 'w', args.silent, args.compress) as xp3:
-            xp3.add_folder(args.input, args.flatten, args.encryption)
+    elif args.mode in ('r', 'repack', 'a', 'append'):
+        if args.policy == 'always':
+            policy = CompressionPolicy.always(args.level)
+        else:
+            policy = CompressionPolicy(args.level, args.large_level, probe=not args.no_probe,
+                                       levels={extension: 0 for extension in args.store})
+        with XP3(args.output, 'a' if args.mode in ('a', 'append') else 'w', args.silent, args.compress,
+                 workers=args.workers, max_inflight_bytes=args.inflight * 1024 * 1024, dedup=args.dedup,
+                 policy=policy, block_size=args.block_size * 1024 * 1024,
+                 segment_size=args.segment_size * 1024 * 1024,
+                 cache=DiskCache(args.cache, args.cache_size * 1024 * 1024) if args.cache else None,
+                 stats=stats) as xp3:
+            if args.base:
+                with XP3(args.base, 'r', silent=True, use_mmap=args.mmap) as base:
+                    xp3.add_folder(args.input, flatten=args.flatten, save_timestamps=not args.no_timestamps,
+                                   base=base, quick=args.quick)
+            else:
+                xp3.add_folder(args.input, flatten=args.flatten, save_timestamps=not args.no_timestamps)
+    if stats is not None:
+        print(stats.report())
@@ -1,32 +1,85 @@
+import mmap
+import time
+import threading
 from io import BytesIO
 from structs import XP3Signature, XP3FileIndex, XP3File
 from encrypt.encrypt_interface import EncryptInterface
+from stats import Stats, no_stats, print_progress
 
 class XP3Reader:
+    # Set by _map_buffer, None in every other mode so close works for writers too
+    _mmap = None
+    view = None
+
     def __init__(self, 
                  buffer: BytesIO, 
                  silent: bool = False, 
                  use_numpy: bool = True,
                  game_name: str = 'none',
-                 encrypt_instance: EncryptInterface = None
+                 encrypt_instance: EncryptInterface = None,
+                 use_mmap: bool = False,
+                 stats: Stats = None,
+                 progress=None
                  ):
+        """
+        :param buffer: Archive file object or bytes
+        :param silent: Supress prints
+        :param use_numpy: Use Numpy for XORing if available
+        :param use_mmap: Map the archive into memory and read segments without copying them
+        :param stats: Report the time and bytes of index parsing and of reading files into it
+        :param progress: progress(action, file_entry) called for every file extracted,
+                         prints a line per file unless silent if not specified (see stats.print_progress)
+        """
         if isinstance(buffer, bytes):
             buffer = BytesIO(buffer)
 
         self.buffer = buffer
         self.silent = silent
         self.use_numpy = use_numpy
+        self.game_name = game_name
+        self.encrypt_instance = encrypt_instance
+        self.stats = stats or no_stats
+        self.progress = progress or (print_progress if not silent else None)
+        self._lock = threading.Lock()  # Lets files be read from several threads
+        if use_mmap:
+            self._map_buffer()
 
         if XP3Signature != self.buffer.read(len(XP3Signature)):
             raise AssertionError('Is not an XP3 file')
 
         if not silent:
             print('Reading the file index', end='')
-        self.file_index = XP3FileIndex.read_from(self.buffer)
+        start = time.perf_counter()
+        index = XP3FileIndex.read_index(self.buffer)
+        self.file_index = XP3FileIndex.from_index(index, self.buffer)
+        self.stats.add('index', time.perf_counter() - start, len(index))
         if not silent:
-            print(', found {} file(s)'.format(len(self.file_index.entries)))
+            print(', found {} file(s)'.format(len(self.file_index)))
+
+    def _map_buffer(self):
+        """Expose the archive as a read-only memoryview, backed by mmap for real files"""
+        try:
+            fileno = self.buffer.fileno()
+        except (AttributeError, OSError):
+            fileno = None
+
+        if fileno is not None:
+            self._mmap = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._mmap)
+        elif hasattr(self.buffer, 'getvalue'):
+            # BytesIO shares its initial bytes object with getvalue(), so this does not copy either
+            self.view = memoryview(self.buffer.getvalue())
 
     def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # Slices handed out by XP3File.read are still alive, leave the mapping to the GC
+            self._mmap = None
         self.buffer.close()
 
     def __enter__(self):
@@ -37,16 +90,24 @@ class XP3Reader:
 
     @property
     def is_encrypted(self):
-        for file in self:
-            if file.is_encrypted:
-                return True
-        return False
+        return self.file_index.is_encrypted
 
     # File access
 
     def __getitem__(self, item):
         """Access a file by it's internal file path or position in file index"""
-        return XP3File(self.file_index[item], self.buffer, self.silent, self.use_numpy)
+        return XP3File(self.file_index[item], self.buffer, self.silent, self.use_numpy, self.view, self._lock,
+                       self.stats)
 
-    def open(self, item):
-        return self.__getitem__(item)
+    def open(self, item, stream=False, **kwargs):
+        """
+        Open a file by it's internal file path or position in file index
+        :param stream: Return a readable stream (XP3File.open_stream) instead of the file,
+                       keyword arguments are passed to it, decrypting with the archive's encryption by default
+        """
+        file = self.__getitem__(item)
+        if not stream:
+            return file
+        kwargs.setdefault('encryption_type', self.game_name)
+        kwargs.setdefault('encrypt_instance', self.encrypt_instance)
+        return file.open_stream(**kwargs)
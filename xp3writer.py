@@ -1,11 +1,18 @@
+import os
+import time
 import zlib
 import struct
 import hashlib
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from structs import XP3FileIndex, XP3IndexSpecialFormat, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo, \
     XP3File, \
     XP3FileEntry, XP3Signature, game_list
 from encrypt.encrypt_interface import EncryptInterface
+from compression import CompressionPolicy, BlockCompressor, compress_parallel
+from cache import DiskCache
+from stats import Stats, no_stats, print_progress
 
 
 class XP3Writer:
@@ -19,27 +26,85 @@ class XP3Writer:
                  use_numpy: bool = True,
                  game_name: str = 'none',
                  encrypt_instance: EncryptInterface = None,
-                 compressed=False
+                 compressed=False,
+                 workers: int = 1,
+                 max_inflight_bytes: int = 256 * 1024 * 1024,
+                 append: bool = False,
+                 dedup: bool = False,
+                 policy: CompressionPolicy = None,
+                 block_size: int = None,
+                 segment_size: int = None,
+                 cache: DiskCache = None,
+                 stats: Stats = None,
+                 progress=None
                  ):
         """
         :param buffer: Buffer object to write data to
         :param silent: Supress prints
         :param use_numpy: Use Numpy for XORing if available
+        :param workers: Number of threads compressing and encrypting added files,
+                        files are still written in the order they were added so the archive does not depend on it
+        :param max_inflight_bytes: With more than one worker, how many bytes of added files may wait to be written
+        :param append: Buffer holds an archive to add files to, its entries and data are kept as they are,
+                       new files are appended and a new index is written when packing up
+        :param dedup: Files added with the same content as one added before point to its segments
+                      instead of being compressed, encrypted and written again
+                      (the buffer has to be readable, a file is read back when another one could be its copy)
+        :param policy: Picks the level of every file when compressed, everything at level 9 if not specified
+        :param block_size: Files of at least twice this size are compressed in blocks of it on all workers,
+                           still as a single zlib stream, the same whatever the number of workers
+                           (a little bigger than compressing them in one go, None does that)
+        :param segment_size: Split files bigger than this in segments of this size compressed on their own,
+                             readers can decode them concurrently and only decode the ones a range read needs
+        :param cache: Keep the compressed and encrypted data of added files in it, adding the same content
+                      again with the same encryption and compression settings skips the work
+        :param stats: Report the time and bytes of checksumming, encrypting, compressing and writing files into it
+        :param progress: progress(action, file_entry) called for every file packed,
+                         prints a line per file unless silent if not specified (see stats.print_progress)
         """
         self.encrypt_instance = encrypt_instance
         self.game_name = game_name
         self.compressed = compressed
+        self.policy = policy or CompressionPolicy.always()
         if not buffer:
             buffer = BytesIO()
         self.buffer = buffer
-        self.file_entries = []
+        self._base_index = None  # Index of the archive appended to, its entries are kept as columns
+        self._removed = set()  # Positions in _base_index of files removed or replaced
         self.silent = silent
         self.use_numpy = use_numpy
-        buffer.seek(0)
-        buffer.write(XP3Signature)
-        buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
+        self.stats = stats or no_stats
+        self.progress = progress or (print_progress if not silent else None)
+        self.appending = append
         self.packed_up = False
-        self._filenames = []
+        # Internal file path -> entry of the files added, in the order they were added, None while they wait
+        self._filenames = {}
+        self.max_inflight_bytes = max_inflight_bytes
+        self._executor = ThreadPoolExecutor(workers) if workers > 1 else None
+        self.block_size = block_size
+        self.segment_size = segment_size
+        self.cache = cache
+        # Separate from _executor, whose threads wait for the blocks,
+        # a single worker still compresses in blocks so the archive does not depend on the number of workers
+        self._block_executor = ThreadPoolExecutor(max(workers, 1)) if block_size else None
+        self._pending = deque()  # (size, future, content, duplicate) in the order files were added
+        self._inflight_bytes = 0
+        self.dedup = dedup
+        self._contents = {}  # (adler32, size) -> {strong hash: entry of the first file with it, None while pending}
+        self.deduplicated_files = 0
+        self.deduplicated_bytes = 0
+
+        if append:
+            buffer.seek(0)
+            if XP3Signature != buffer.read(len(XP3Signature)):
+                raise AssertionError('Is not an XP3 file')
+            self._base_index = XP3FileIndex.read_from(buffer)
+            # New data goes after the old index, so the archive stays valid until the header points to the new one
+            buffer.seek(0, 2)
+        else:
+            buffer.seek(0)
+            buffer.write(XP3Signature)
+            buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
 
     def __enter__(self):
         return self
@@ -49,30 +114,296 @@ class XP3Writer:
             self.pack_up()
         self.buffer.close()
 
-    def add(self, internal_filepath: str, file: bytes, timestamp: int = 0):
+    def add(self, internal_filepath: str, file: bytes, timestamp: int = 0, replace: bool = False):
         """
         Add a file to the archive
         :param internal_filepath: Internal file path
         :param file: File to add
         :param encryption_type: Encryption type to encrypt with
         :param timestamp: Timestamp (in milliseconds) to save
+        :param replace: Replace a file with the same path instead of raising FileExistsError
+        """
+        self._reserve(internal_filepath, replace)
+        adler32, content = None, None
+        if self.dedup:
+            with self.stats.measure('checksum', len(file)):
+                adler32 = zlib.adler32(file)
+            content = self._content(adler32, file)
+            if content[1] in self._contents[content[0]]:
+                if self._pending:  # Keep the order files were added in, the first one may not be written yet
+                    self._pending.append((0, None, content, (internal_filepath, timestamp)))
+                else:
+                    self._write_duplicate(internal_filepath, content, timestamp)
+                return
+            self._contents[content[0]][content[1]] = None
+
+        if self._executor is None:
+            file_entry, file = self._create_file_entry(
+                internal_filepath=internal_filepath,
+                uncompressed_data=file,
+                offset=self.buffer.tell(),
+                timestamp=timestamp,
+                adler32=adler32)
+            self._write(file_entry, file, content)
+            return
+
+        future = self._executor.submit(self._create_file_entry, internal_filepath, file, 0, timestamp, adler32)
+        self._pending.append((len(file), future, content, None))
+        self._inflight_bytes += len(file)
+        self._drain(self.max_inflight_bytes)
+
+    def _content(self, adler32: int, file: bytes) -> tuple[tuple[int, int], bytes]:
+        """
+        Key of the content of a file for dedup, the strong hash is only computed
+        once another file with the same checksum and size shows up
+        """
+        prefilter = (adler32, len(file))
+        known = self._contents.setdefault(prefilter, {})
+        if not known:
+            return prefilter, b''
+        if b'' in known:
+            # The first file with this checksum and size was taken on trust, hash it now it has company
+            self._drain()  # It may still be waiting for the workers
+            entry = known.pop(b'')
+            known[self._strong_hash(self._stored_content(entry))] = entry
+        return prefilter, self._strong_hash(file)
+
+    @staticmethod
+    def _strong_hash(file: bytes) -> bytes:
+        return hashlib.blake2b(file, digest_size=32).digest()
+
+    def _stored_content(self, file_entry: XP3FileEntry) -> bytes:
+        """Read back the content of a file already written, to hash it"""
+        position = self.buffer.tell()
+        try:
+            data = XP3File(file_entry, self.buffer, True, self.use_numpy).read(
+                self.game_name, encrypt_instance=self.encrypt_instance)
+        finally:
+            self.buffer.seek(position)
+        return bytes(data)
+
+    def _write_duplicate(self, internal_filepath: str, content: tuple[tuple[int, int], bytes], timestamp: int):
+        """Register a file pointing at the segments of the first file added with the same content"""
+        original = self._contents[content[0]][content[1]]
+        file_entry = self._file_entry(internal_filepath, original.adler32, list(original.segm), timestamp)
+        self.deduplicated_files += 1
+        self.deduplicated_bytes += original.segm.compressed_size
+        self._register(file_entry)
+
+    def add_stream(self, internal_filepath: str, fileobj, timestamp: int = 0, chunk_size: int = 1024 * 1024,
+                   replace: bool = False):
+        """
+        Add a file to the archive from a file object, reading, encrypting and compressing it chunk by chunk
+        so memory use is bounded by chunk_size instead of the size of the file
+        :param internal_filepath: Internal file path
+        :param fileobj: Binary file object to read from, must be seekable for encrypted archives
+                        (the keys depend on the checksum of the whole file, so it is read twice)
+        :param timestamp: Timestamp (in milliseconds) to save
+        :param chunk_size: Number of bytes read at once
+        :param replace: Replace a file with the same path instead of raising FileExistsError
         """
+        if self._is_encrypting and not fileobj.seekable():
+            raise ValueError('Encrypted archives need a seekable file object to stream from')
+
+        self._reserve(internal_filepath, replace)
+        self._drain()  # Files added before have to be written first
+        start = fileobj.tell() if fileobj.seekable() else None
+
+        adler32 = 1  # Adler-32 initial value
+        if self._is_encrypting:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                with self.stats.measure('checksum', len(chunk)):
+                    adler32 = zlib.adler32(chunk, adler32)
+            fileobj.seek(start)
+
+        level = None  # Picked once the first chunk is read
+        segments = []
+        compressor = None
+        segment_start, segment_offset = 0, self.buffer.tell()  # Where the current segment starts in file and buffer
+        position = 0
+        for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+            if self._is_encrypting:
+                chunk = self._encrypt(chunk, adler32, position)
+            else:
+                with self.stats.measure('checksum', len(chunk)):
+                    adler32 = zlib.adler32(chunk, adler32)
+            if level is None:
+                # The first chunk stands in for the whole file when probing
+                level = self.policy.level_for(internal_filepath, chunk, self._stream_size(fileobj, start)) \
+                    if self.compressed else 0
+
+            view = memoryview(chunk)
+            while view:
+                if compressor is None and level:
+                    compressor = self._compressor(level)
+                size = len(view)
+                if self.segment_size:
+                    size = min(size, segment_start + self.segment_size - position)
+                if compressor:
+                    with self.stats.measure('compress', size):
+                        self._output(compressor.compress(view[:size]))
+                else:
+                    self._output(view[:size])
+                view = view[size:]
+                position += size
+                if self.segment_size and position - segment_start == self.segment_size:
+                    segments.append(self._end_segment(compressor, fileobj, start, segment_start, position,
+                                                      segment_offset, adler32, chunk_size))
+                    compressor, segment_start, segment_offset = None, position, self.buffer.tell()
+        if position > segment_start or not segments:
+            if compressor is None and level:
+                compressor = self._compressor(level)
+            segments.append(self._end_segment(compressor, fileobj, start, segment_start, position, segment_offset,
+                                              adler32, chunk_size))
+
+        self._register(self._file_entry(internal_filepath, adler32, segments, timestamp))
+
+    def _compressor(self, level: int):
+        """Compressor of a segment, compressing in blocks on all workers if enabled"""
+        if self._block_executor is not None:
+            return BlockCompressor(level, self._block_executor, self.block_size)
+        return zlib.compressobj(level=level)
+
+    def _end_segment(self, compressor, fileobj, start: int, segment_start: int, position: int, offset: int,
+                     adler32: int, chunk_size: int):
+        """
+        Finish a segment of add_stream written to the buffer from offset,
+        if compression did not pay off and the file object can be read again, the segment is stored instead
+        :return: The segment
+        """
+        if compressor:
+            with self.stats.measure('compress'):
+                data = compressor.flush()
+            self._output(data)
+        uncompressed_size = position - segment_start
+        compressed_size = self.buffer.tell() - offset
+        is_compressed = compressor is not None
+        if is_compressed and compressed_size >= uncompressed_size and start is not None:
+            # Store the segment as is like add does
+            resume = fileobj.tell()
+            fileobj.seek(start + segment_start)
+            self.buffer.seek(offset)
+            for chunk_start in range(segment_start, position, chunk_size):
+                chunk = fileobj.read(min(chunk_size, position - chunk_start))
+                if self._is_encrypting:
+                    chunk = self._encrypt(chunk, adler32, chunk_start)
+                self._output(chunk)
+            self.buffer.truncate()
+            fileobj.seek(resume)
+            compressed_size = uncompressed_size
+            is_compressed = False
+        return XP3FileSegments.segment(is_compressed=is_compressed, offset=offset,
+                                       uncompressed_size=uncompressed_size, compressed_size=compressed_size)
+
+    @staticmethod
+    def _stream_size(fileobj, start: int):
+        """Bytes left in a file object from start, None if it can not tell"""
+        if start is None:
+            return None
+        position = fileobj.tell()
+        size = fileobj.seek(0, 2) - start
+        fileobj.seek(position)
+        return size
+
+    def add_raw(self, file: XP3File, replace: bool = False, chunk_size: int = 1024 * 1024):
+        """
+        Copy a file from another archive as it is stored, without decompressing or decrypting it,
+        its adlr, info, time and maker specific chunks are kept as they are
+        (so it is only readable if this archive uses the same encryption as the one it comes from)
+        :param file: File of an archive open for reading
+        :param replace: Replace a file with the same path instead of raising FileExistsError
+        :param chunk_size: Number of bytes copied at once
+        """
+        self._reserve(file.file_path, replace)
+        self._drain()  # Files added before have to be written first
+
+        segments = []
+        for segment in file.segm:
+            offset = self.buffer.tell()
+            for position in range(0, segment.compressed_size, chunk_size):
+                size = min(chunk_size, segment.compressed_size - position)
+                data = file.read_at(segment.offset + position, size)
+                if len(data) != size:
+                    raise AssertionError('Segment at {} is truncated'.format(segment.offset))
+                self._output(data)
+            segments.append(segment._replace(offset=offset))
+
+        self._register(XP3FileEntry(time=file.time, adlr=file.adlr, segm=XP3FileSegments(segments), info=file.info,
+                                    special_format=file.special_format))
+
+    def remove(self, internal_filepath: str):
+        """Remove a file from the archive index, its data stays in the archive unreferenced"""
+        if internal_filepath in self._filenames:
+            self._drain()  # The entry may still be waiting for the workers
+            del self._filenames[internal_filepath]
+            return
+        position = self._base_position(internal_filepath)
+        if position is None:
+            raise FileNotFoundError(internal_filepath)
+        self._removed.add(position)
+
+    def _base_position(self, internal_filepath: str):
+        """Position of a file of the archive appended to that is still in it, None if there is none"""
+        if self._base_index is None:
+            return None
+        position = self._base_index.path_index.get(internal_filepath)
+        return None if position in self._removed else position
+
+    @property
+    def file_entries(self) -> list:
+        """Entries of every file in the archive, the ones of the archive appended to first"""
+        entries = [] if self._base_index is None else \
+            [entry for position, entry in enumerate(self._base_index) if position not in self._removed]
+        return entries + [entry for entry in self._filenames.values() if entry is not None]
+
+    def _reserve(self, internal_filepath: str, replace: bool):
+        """Claim an internal file path for a file about to be added"""
         if self.packed_up:
             raise Exception('Archive is already packed up')
-        if internal_filepath in self._filenames:
-            raise FileExistsError
-
-        self._filenames.append(internal_filepath)
-        file_entry, file = self._create_file_entry(
-            internal_filepath=internal_filepath,
-            uncompressed_data=file,
-            offset=self.buffer.tell(),
-            timestamp=timestamp)
-        self.file_entries.append(file_entry)
-        if not self.silent:
-            print(
-                f'| Packing {internal_filepath} ({file_entry.segm.uncompressed_size} -> {file_entry.segm.compressed_size} bytes)')
-        self.buffer.write(file)
+        if internal_filepath in self._filenames or self._base_position(internal_filepath) is not None:
+            if not replace:
+                raise FileExistsError
+            self.remove(internal_filepath)
+        self._filenames[internal_filepath] = None
+
+    def _drain(self, max_inflight_bytes: int = -1):
+        """
+        Write finished files in the order they were added,
+        waits for the oldest ones while more than max_inflight_bytes are queued (all of them by default)
+        """
+        while self._pending:
+            size, future, content, duplicate = self._pending[0]
+            if duplicate is not None:  # Everything added before it is written, including the first copy
+                self._pending.popleft()
+                self._write_duplicate(duplicate[0], content, duplicate[1])
+                continue
+            if self._inflight_bytes <= max_inflight_bytes and not future.done():
+                break
+            file_entry, file = future.result()
+            self._pending.popleft()
+            self._inflight_bytes -= size
+            # Entries are created with segments relative to 0, point them to where they end up
+            offset = self.buffer.tell()
+            file_entry.segm = XP3FileSegments([segment._replace(offset=offset + segment.offset)
+                                               for segment in file_entry.segm])
+            self._write(file_entry, file, content)
+
+    def _write(self, file_entry: XP3FileEntry, file: bytes, content: tuple[tuple[int, int], bytes] = None):
+        self._register(file_entry)
+        self._output(file)
+        if content is not None:
+            self._contents[content[0]][content[1]] = file_entry
+
+    def _register(self, file_entry: XP3FileEntry):
+        """Add the entry of a file written to the buffer to the index"""
+        self._filenames[file_entry.file_path] = file_entry
+        if self.progress is not None:
+            self.progress('pack', file_entry)
+
+    def _output(self, data):
+        """Write data at the current position of the buffer"""
+        with self.stats.measure('write', len(data)):
+            self.buffer.write(data)
 
     def pack_up(self) -> bytes:
         """
@@ -83,10 +414,29 @@ class XP3Writer:
             if hasattr(self.buffer, 'getvalue'):
                 return self.buffer.getvalue()
 
+        self._drain()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if self._block_executor is not None:
+            self._block_executor.shutdown()
+        if self.cache is not None and not self.silent:
+            print(f'| Compression cache: {self.cache.hits} hits, {self.cache.misses} misses')
+        if self.deduplicated_files and not self.silent:
+            print(f'| Deduplicated {self.deduplicated_files} files, saved {self.deduplicated_bytes} bytes')
+
         # Write the file index
-        file_index = XP3FileIndex.from_entries(self.file_entries).to_bytes(self.compressed)
+        start = time.perf_counter()
+        file_index = XP3FileIndex() if self._base_index is None else self._base_index.copy(self._removed)
+        for file_entry in self._filenames.values():
+            if file_entry is not None:
+                file_index.append(file_entry)
+        file_index = file_index.to_bytes(self.compressed)
+        self.stats.add('index', time.perf_counter() - start, len(file_index))
         file_index_offset = self.buffer.tell()
-        self.buffer.write(file_index)
+        self._output(file_index)
+
+        if self.appending:
+            self.buffer.truncate()
 
         # Go back to the header and write the offset
         self.buffer.seek(len(XP3Signature))
@@ -104,7 +454,8 @@ class XP3Writer:
             internal_filepath,
             uncompressed_data,
             offset,
-            timestamp: int = 0
+            timestamp: int = 0,
+            adler32: int = None
     ) -> tuple[XP3FileEntry, bytes]:
         """
         Create a file entry for a file
@@ -113,58 +464,145 @@ class XP3Writer:
         :param offset: Position in the buffer to put into the segment data
         :param encryption_type: Encryption type to use
         :param timestamp Timestamp (in milliseconds)
+        :param adler32: Adler-32 checksum of the file if already known
         :return XP3FileEntry object and compressed or uncompressed file (to write into buffer)
         """
-        encryption_type = self.game_name
-        adlr = XP3FileAdler.from_data(uncompressed_data)
+        key = None
+        if self.cache is not None:
+            key = self._cache_key(internal_filepath, uncompressed_data)
+            cached = self.cache.get(key)
+            if cached is not None:
+                adler32, segments, data = self._from_cache(cached, offset)
+                return self._file_entry(internal_filepath, adler32, segments, timestamp), data
+
+        if adler32 is None:
+            with self.stats.measure('checksum', len(uncompressed_data)):
+                adler32 = zlib.adler32(uncompressed_data)
+        if self._is_encrypting:
+            uncompressed_data = self._encrypt(uncompressed_data, adler32)
+
+        level = self.policy.level_for(internal_filepath, uncompressed_data) if self.compressed else 0
+        if self.segment_size and len(uncompressed_data) > self.segment_size:
+            view = memoryview(uncompressed_data)
+            pieces = [view[start:start + self.segment_size] for start in range(0, len(view), self.segment_size)]
+        else:
+            pieces = [uncompressed_data]
+        if len(pieces) > 1:
+            # Segments are compressed on their own, on all workers if there is a pool for blocks
+            compress = lambda piece: self._compress(piece, level, blocks=False)
+            parts = self._block_executor.map(compress, pieces) if self._block_executor else map(compress, pieces)
+        else:
+            parts = [self._compress(pieces[0], level)]
+
+        segments, data = [], []
+        for piece, (is_compressed, part) in zip(pieces, parts):
+            segments.append(XP3FileSegments.segment(
+                is_compressed=is_compressed,
+                offset=offset,
+                uncompressed_size=len(piece),
+                compressed_size=len(part)
+            ))
+            offset += len(part)
+            data.append(part)
+        data = b''.join(data)
+        if key is not None:
+            self.cache.put(key, self._to_cache(adler32, segments, data))
+        return self._file_entry(internal_filepath, adler32, segments, timestamp), data
+
+    _cached_header = struct.Struct('<II')  # Adler-32, number of segments
+    _cached_segment = struct.Struct('<?QQ')  # Is compressed, uncompressed size, compressed size
+
+    def _cache_key(self, internal_filepath: str, data: bytes) -> str:
+        """
+        Everything the stored bytes of a file depend on, the extension picks the compression level
+        The encryption counts by its class and parameters, its string does not always include its keys
+        """
+        crypt = type(self.encrypt_instance)
+        return DiskCache.key(hashlib.sha256(data).hexdigest(), self.game_name,
+                             crypt.__module__, crypt.__qualname__, sorted(vars(self.encrypt_instance).items()),
+                             self.compressed, sorted(vars(self.policy).items()), self.block_size, self.segment_size,
+                             os.path.splitext(internal_filepath)[1].lower())
 
-        is_encrypted = False if encryption_type in ('none', None) else True
+    def _to_cache(self, adler32: int, segments: list, data: bytes) -> bytes:
+        header = self._cached_header.pack(adler32, len(segments))
+        return header + b''.join(self._cached_segment.pack(segment.is_compressed, segment.uncompressed_size,
+                                                           segment.compressed_size)
+                                 for segment in segments) + data
+
+    def _from_cache(self, cached: bytes, offset: int) -> tuple[int, list, memoryview]:
+        """Adler-32, segments starting at offset and stored bytes of a cached file"""
+        adler32, count = self._cached_header.unpack_from(cached)
+        position = self._cached_header.size
+        segments = []
+        for _ in range(count):
+            is_compressed, uncompressed_size, compressed_size = self._cached_segment.unpack_from(cached, position)
+            position += self._cached_segment.size
+            segments.append(XP3FileSegments.segment(is_compressed=is_compressed, offset=offset,
+                                                    uncompressed_size=uncompressed_size,
+                                                    compressed_size=compressed_size))
+            offset += compressed_size
+        return adler32, segments, memoryview(cached)[position:]
+
+    def _compress(self, data, level: int, blocks: bool = True) -> tuple[bool, bytes]:
+        """
+        Compress data at level, keeping it as it is if that does not make it smaller
+        :param blocks: Compress it in blocks on all workers if enabled and big enough
+        :return: If it is compressed, the data to write
+        """
+        if not level:
+            return False, data
+        with self.stats.measure('compress', len(data)):
+            if blocks and self._block_executor is not None and len(data) >= 2 * self.block_size:
+                compressed = compress_parallel(data, level, self._block_executor, self.block_size)
+            else:
+                compressed = zlib.compress(data, level=level)
+        if len(compressed) >= len(data):
+            return False, data
+        return True, compressed
+
+    @property
+    def _is_encrypting(self) -> bool:
+        return self.game_name not in ('none', None)
+
+    def _file_entry(self, internal_filepath: str, adler32: int, segments: list, timestamp: int = 0) -> XP3FileEntry:
+        """
+        Build the index entry of a file already written as segments
+        :param internal_filepath: Internal file path
+        :param adler32: Adler-32 checksum of the unencrypted file
+        :param segments: XP3FileSegments.segment list
+        :param timestamp Timestamp (in milliseconds)
+        """
+        encryption_type = self.game_name
+        is_encrypted = self._is_encrypting
         if is_encrypted:
-            uncompressed_data = self.encrypt(uncompressed_data, adlr.value, self.use_numpy, self.encrypt_instance)
             _, _, special_index_chunk_name = game_list[encryption_type]
             if special_index_chunk_name:
-                special_format = XP3IndexSpecialFormat(adlr.value, internal_filepath, special_index_chunk_name)
+                special_format = XP3IndexSpecialFormat(adler32, internal_filepath, special_index_chunk_name)
                 path_hash = hashlib.md5(internal_filepath.lower().encode('utf-16le')).hexdigest()
             else:
                 special_format = path_hash = None
         else:
             special_format = path_hash = None
 
-        uncompressed_size = len(uncompressed_data)
-        compressed_data = zlib.compress(uncompressed_data, level=9) if self.compressed else uncompressed_data
-        compressed_size = len(compressed_data)
-
-        if compressed_size >= uncompressed_size:
-            data = uncompressed_data
-            compressed_size = uncompressed_size
-            is_compressed = False
-        else:
-            data = compressed_data
-            is_compressed = True
-
-        time = XP3FileTime(timestamp)
+        segm = XP3FileSegments(segments)
         info = XP3FileInfo(is_encrypted=is_encrypted,
-                           uncompressed_size=uncompressed_size,
-                           compressed_size=compressed_size,
+                           uncompressed_size=segm.uncompressed_size,
+                           compressed_size=segm.compressed_size,
                            file_path=internal_filepath if not path_hash else path_hash  ## modified for me, fuck
                            )
 
-        segment = XP3FileSegments.segment(
-            is_compressed=is_compressed,
-            offset=offset,
-            uncompressed_size=uncompressed_size,
-            compressed_size=compressed_size
-        )
-        segm = XP3FileSegments([segment])
+        return XP3FileEntry(special_format=special_format, time=XP3FileTime(timestamp), adlr=XP3FileAdler(adler32),
+                            segm=segm, info=info)
 
-        file_entry = XP3FileEntry(special_format=special_format, time=time, adlr=adlr, segm=segm, info=info)
-
-        return file_entry, data
+    def _encrypt(self, data: bytes, adler32: int, offset: int = 0) -> bytearray:
+        """Encrypted copy of data with the archive's encryption"""
+        with self.stats.measure('encrypt', len(data)):
+            return self.encrypt(data, adler32, self.use_numpy, self.encrypt_instance, offset)
 
     @staticmethod
-    def encrypt(data: bytes, adler32: int, use_numpy: bool, encrypt_instance: EncryptInterface):
-        with BytesIO() as buffer:
-            buffer.write(data)
-
-            encrypt_instance.encrypt(buffer, adler32, use_numpy)
-            return buffer.getvalue()
+    def encrypt(data: bytes, adler32: int, use_numpy: bool, encrypt_instance: EncryptInterface,
+                offset: int = 0) -> bytearray:
+        """Encrypted copy of data, the only copy made on the way"""
+        data = bytearray(data)
+        encrypt_instance.encrypt_buffer(data, adler32, offset, use_numpy)
+        return data